@@ -0,0 +1,239 @@
+"""
+Benchmarks for the material lookup pipeline, run against synthetic data:
+
+    python benchmarks.py memory --materials 1000000
+    python benchmarks.py tokenize --declarations 200000
+    python benchmarks.py canonicalize --tokens 1000000
+    python benchmarks.py nutrition --materials 100000
+    python benchmarks.py bom --nodes 20000
+"""
+import argparse
+import gc
+import random
+import re
+import time
+import tracemalloc
+
+import pandas as pd
+import pyarrow as pa
+
+from materials import (INGREDIENT_SYNONYMS, RAW_COLUMNS, Canonicalizer, MaterialStore, default_nutrient_unit,
+                       expand_bom, format_nutrition, parse_nutrient_value, parse_nutrition_string, tokenize_column,
+                       tokenize_ingredients)
+
+INGREDIENT_WORDS = [
+    "wheat flour", "sugar", "palm oil", "cocoa butter", "whole milk powder", "salt",
+    "glucose syrup", "emulsifier", "soya lecithin", "hazelnuts", "skimmed milk powder",
+    "rapeseed oil", "yeast", "barley malt extract", "raising agent", "sodium bicarbonate",
+    "natural flavouring", "egg powder", "vanilla extract", "almonds", "citric acid",
+    "maize starch", "dextrose", "whey powder", "butter", "cocoa mass", "oat flakes",
+]
+NESTED_INGREDIENTS = [
+    "milk chocolate 12% (sugar, cocoa butter, whole milk powder 3,5%, cocoa mass, emulsifier (soya lecithin))",
+    "Wheat Flour (fortified)", "flour (wheat)", "caramel pieces 4% (sugar, glucose syrup, butter (milk))",
+    "vegetable fat (palm, shea)", "raising agents (E450, E500)", "hazelnut paste 13%",
+]
+ALLERGEN_WORDS = ["milk", "wheat", "gluten", "soya", "egg", "hazelnut", "almond", "barley", "oat", "sesame"]
+NUTRIENTS = [("Energy", "kcal", 600), ("Protein", "g", 30), ("Carbohydrate", "g", 90),
+             ("Fat", "g", 60), ("Sugars", "g", 60), ("Sodium", "mg", 900)]
+
+
+def make_rows(n, seed=0):
+    """Yields n raw allergen_info rows with realistic-looking free text."""
+    rnd = random.Random(seed)
+    for i in range(n):
+        ingredients = rnd.sample(INGREDIENT_WORDS, rnd.randint(4, 12))
+        if rnd.random() < 0.4:
+            ingredients[rnd.randrange(len(ingredients))] = rnd.choice(NESTED_INGREDIENTS)
+        allergens = rnd.sample(ALLERGEN_WORDS, rnd.randint(0, 3))
+        may_contain = rnd.sample(ALLERGEN_WORDS, rnd.randint(0, 2))
+        nutrition = ", ".join(
+            f"{name}: {rnd.uniform(0, top):.1f}{unit}" for name, unit, top in NUTRIENTS if rnd.random() < 0.9
+        )
+        yield (
+            str(100000 + i),
+            ", ".join(ingredients[:-1]) + " and " + ingredients[-1],
+            ", ".join(allergens),
+            ", ".join(may_contain),
+            nutrition,
+        )
+
+
+def _retained(build):
+    """Returns (result, bytes still allocated after build(), seconds)."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+
+def bench_memory(materials, baseline_materials):
+    def build_baseline():
+        rows = list(make_rows(baseline_materials))
+        df = parse_fields(pd.DataFrame(rows, columns=RAW_COLUMNS))
+        del rows
+        return df
+
+    _, baseline_bytes, baseline_time = _retained(build_baseline)
+    store, store_bytes, store_time = _retained(lambda: MaterialStore.from_records(make_rows(materials)))
+
+    baseline_per = baseline_bytes / baseline_materials
+    store_per = store_bytes / materials
+    print(f"DataFrame + parse_fields : {baseline_materials:>9,} materials  "
+          f"{baseline_per:8.0f} B/material  {baseline_time:6.2f}s")
+    print(f"MaterialStore            : {materials:>9,} materials  "
+          f"{store_per:8.0f} B/material  {store_time:6.2f}s  (nbytes={store.nbytes / 1e6:.1f} MB)")
+    print(f"reduction                : {baseline_per / store_per:.1f}x  (timings include tracemalloc overhead)")
+
+
+def legacy_split_tokens(x):
+    """The re.split based tokenizer that tokenize_ingredients() replaced."""
+    if pd.isna(x) or not x:
+        return []
+    return [i.strip().lower() for i in re.split(r',| and ', str(x)) if i.strip()]
+
+
+def parse_fields(df):
+    """The object-dtype parsing that MaterialStore replaced: one Python list or dict per cell."""
+    df['ingredients'] = df.get('ingredients', '').apply(legacy_split_tokens)
+    df['allergen'] = df.get('allergen', '').apply(legacy_split_tokens)
+    df['allergen_may_contain'] = df.get('allergen_may_contain', '').apply(legacy_split_tokens)
+    df['nutritional_information'] = df['nutritional_information'].apply(parse_nutrition_string)
+    return df
+
+
+def calculate_nutrition(df, weights=None):
+    """The row-by-row nutrition totals that MaterialStore.nutrient_totals() replaced."""
+    total = {}
+    units = {}
+
+    for _, row in df.iterrows():
+        nutrition = row['nutritional_information']
+        material_no = row['material_no']
+        weight = weights.get(material_no, 100) if weights else 100
+
+        for k, v in nutrition.items():
+            parsed = parse_nutrient_value(v)
+            if parsed is None:
+                continue
+            val, unit = parsed
+            total[k] = total.get(k, 0.0) + val * (weight / 100.0)
+            units[k] = unit or default_nutrient_unit(k)
+
+    return format_nutrition(total, units)
+
+
+def bench_tokenize(declarations):
+    texts = [row[1] for row in make_rows(declarations)]
+    column = pa.array(texts, pa.string())
+
+    def timed(label, run):
+        started = time.perf_counter()
+        tokens = run()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<28}: {declarations / elapsed:>12,.0f} declarations/s  {tokens:>10,} tokens")
+
+    timed("re.split (legacy)", lambda: sum(len(legacy_split_tokens(t)) for t in texts))
+    timed("tokenize_ingredients", lambda: sum(len(tokenize_ingredients(t)[0]) for t in texts))
+    timed("tokenize_column (Arrow)", lambda: len(tokenize_column(column)[0]))
+
+
+def bench_nutrition(materials):
+    rows = list(make_rows(materials))
+    weights = {row[0]: (i % 50) + 1 for i, row in enumerate(rows)}
+    df = parse_fields(pd.DataFrame(rows, columns=RAW_COLUMNS))
+    store = MaterialStore.from_records(rows)
+
+    started = time.perf_counter()
+    legacy = calculate_nutrition(df, weights)
+    legacy_time = time.perf_counter() - started
+    started = time.perf_counter()
+    totals = store.nutrition_totals(weights)
+    store_time = time.perf_counter() - started
+    print(f"calculate_nutrition (legacy)  : {materials / legacy_time:>14,.0f} materials/s")
+    print(f"MaterialStore.nutrition_totals: {materials / store_time:>14,.0f} materials/s")
+    print(f"totals agree                  : {legacy == totals}")
+
+
+def make_tokens(n, seed=0):
+    """n ingredient tokens drawn from a skewed pool of variants, qualifiers and typos."""
+    rnd = random.Random(seed)
+    names = sorted(set(INGREDIENT_SYNONYMS) | set(INGREDIENT_SYNONYMS.values()) | set(INGREDIENT_WORDS))
+    pool = []
+    for name in names:
+        pool += [name, name.title(), f"organic {name}", f"{name}s"]
+        i = rnd.randrange(len(name))
+        pool.append(name[:i] + name[i + 1:])
+    pool += [f"ingredient {i}" for i in range(len(pool))]
+    weights = [1 / (rank + 1) for rank in range(len(pool))]
+    rnd.shuffle(pool)
+    return rnd.choices(pool, weights=weights, k=n)
+
+
+def bench_canonicalize(n_tokens):
+    tokens = make_tokens(n_tokens)
+    canonicalizer = Canonicalizer()
+    started = time.perf_counter()
+    canonical = [canonicalizer.canonical(token) for token in tokens]
+    elapsed = time.perf_counter() - started
+    info = canonicalizer.canonical.cache_info()
+    print(f"canonicalize: {n_tokens:,} tokens ({info.misses:,} distinct) in {elapsed:.2f}s  "
+          f"{n_tokens / elapsed:,.0f} tokens/s  {len(set(canonical)):,} canonical names")
+
+
+def bench_bom(n_nodes, recipe_every=100):
+    """
+    A deep BOM where node i is made of nodes i + 1 and i + 2 and every node
+    declares an ingredient no other node has, so roll-ups near the top hold
+    almost the whole vocabulary. Every recipe_every-th node is a recipe.
+    """
+    rows = [(f"BOM{i}", f"ingredient {i}", ALLERGEN_WORDS[i % len(ALLERGEN_WORDS)], "", f"Energy: {i % 500}kcal")
+            for i in range(n_nodes)]
+    edges = {f"BOM{i}": ([f"BOM{i + 1}", f"BOM{i + 2}"], [60, 40]) for i in range(n_nodes - 2)}
+    nodes = MaterialStore.from_records(rows)
+    recipes = [f"BOM{i}" for i in range(0, n_nodes, recipe_every)]
+
+    started = time.perf_counter()
+    store, _, _ = expand_bom(nodes, {row[0] for row in rows}, edges, recipes)
+    elapsed = time.perf_counter() - started
+    offsets, _ = store.lists["ingredients"]
+    print(f"expand_bom: {n_nodes:,} nodes, {len(recipes):,} recipes in {elapsed:.2f}s; "
+          f"the top recipe rolls up {offsets[1]:,} ingredients")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    memory = sub.add_parser("memory", help="per-material memory of the parsed records")
+    memory.add_argument("--materials", type=int, default=1_000_000)
+    memory.add_argument("--baseline-materials", type=int, default=50_000,
+                        help="the object-dtype baseline is measured on a smaller sample")
+    tokenize = sub.add_parser("tokenize", help="ingredient tokenizer throughput")
+    tokenize.add_argument("--declarations", type=int, default=200_000)
+    canonicalize = sub.add_parser("canonicalize", help="ingredient canonicalization throughput")
+    canonicalize.add_argument("--tokens", type=int, default=1_000_000)
+    nutrition = sub.add_parser("nutrition", help="weighted nutrition totals")
+    nutrition.add_argument("--materials", type=int, default=100_000)
+    bom = sub.add_parser("bom", help="bill of materials roll-up with a distinct ingredient per node")
+    bom.add_argument("--nodes", type=int, default=20_000)
+    args = parser.parse_args()
+
+    if args.bench == "memory":
+        bench_memory(args.materials, args.baseline_materials)
+    elif args.bench == "tokenize":
+        bench_tokenize(args.declarations)
+    elif args.bench == "canonicalize":
+        bench_canonicalize(args.tokens)
+    elif args.bench == "nutrition":
+        bench_nutrition(args.materials)
+    elif args.bench == "bom":
+        bench_bom(args.nodes)
+
+
+if __name__ == "__main__":
+    main()
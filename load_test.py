@@ -0,0 +1,291 @@
+"""
+Load test for main.py: drives concurrent Streamlit sessions through the
+testing API, each uploading a generated recipe file, against a throwaway
+local Postgres cluster (initdb/pg_ctl on PATH) or an existing database:
+
+    python load_test.py --sessions 50 --concurrency 10
+    python load_test.py --dsn "host=db.internal dbname=allergen_load user=load password=..." --seed
+
+--seed refuses to replace an allergen_info table that already has rows
+unless --drop-existing is also given.
+
+Reports upload-to-render latency percentiles, throughput, database
+connections opened by the app, peak server backends and peak RSS. A
+session only counts as successful when the lookup results rendered.
+"""
+import argparse
+import csv
+import glob
+import io
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from unittest.mock import MagicMock
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.dataframe_source_manager import DataframeSourceManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+
+from benchmarks import make_rows
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# main.py connects on the default port; the local cluster listens on a private socket directory instead
+APP_PORT = "5432"
+FIRST_MATERIAL = 100000
+
+
+def share_test_runtime():
+    """
+    AppTest installs a mock Runtime for each run and clears it when the run
+    ends, which breaks any other session running at that moment. Pin one
+    mock for the whole test instead, the way a server shares one Runtime.
+    """
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = DataframeSourceManager()
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+
+
+def share_script_cache():
+    """
+    Every AppTest run compiles main.py into a fresh ScriptCache, and CPython's
+    parser fails when several threads compile at once ("SystemError: AST
+    constructor recursion depth mismatch"). Share one cache, as a server
+    does, so the script is compiled once, under the cache's lock.
+    """
+    shared = ScriptCache()
+    get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(shared, script_path)
+
+
+class ConnectionCounter:
+    """Wraps psycopg2.connect to count the connections the app opens."""
+
+    def __init__(self):
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.connect = psycopg2.connect
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            self.opened += 1
+        return self.connect(*args, **kwargs)
+
+
+class ActivitySampler(threading.Thread):
+    """Polls pg_stat_activity for the peak number of backends on the test database."""
+
+    def __init__(self, connect, interval=0.05):
+        super().__init__(daemon=True)
+        self.conn = connect()
+        self.conn.autocommit = True
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def run(self):
+        with self.conn.cursor() as cursor:
+            while not self.done.is_set():
+                cursor.execute("SELECT count(*) FROM pg_stat_activity "
+                               "WHERE datname = current_database() AND pid <> pg_backend_pid()")
+                self.peak = max(self.peak, cursor.fetchone()[0])
+                self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.conn.close()
+
+
+class LocalPostgres:
+    """A temporary cluster with trust auth, reachable only through a unix socket in its own directory."""
+
+    def __init__(self, dbname="allergen", user="loadtest", max_connections=200):
+        self.dbname, self.user, self.max_connections = dbname, user, max_connections
+        self.bindir = self.find_bindir()
+
+    @staticmethod
+    def find_bindir():
+        initdb = shutil.which("initdb") or next(iter(sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"))), None)
+        if initdb is None:
+            raise SystemExit("initdb not found; install PostgreSQL or pass --dsn")
+        return os.path.dirname(initdb)
+
+    def __enter__(self):
+        self.workdir = tempfile.mkdtemp(prefix="allergen-pg-")
+        self.datadir = os.path.join(self.workdir, "data")
+        self.socketdir = self.workdir
+        self.tool("initdb", "-D", self.datadir, "-U", self.user, "--auth=trust", "-E", "UTF8")
+        options = f"-c listen_addresses='' -k {self.socketdir} -p {APP_PORT} -c max_connections={self.max_connections}"
+        self.tool("pg_ctl", "-D", self.datadir, "-o", options, "-l", os.path.join(self.workdir, "log"), "-w", "start")
+        conn = psycopg2.connect(dbname="postgres", user=self.user, host=self.socketdir, port=APP_PORT)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f'CREATE DATABASE "{self.dbname}"')
+        conn.close()
+        return {"user": self.user, "password": "", "host": self.socketdir, "dbname": self.dbname}
+
+    def __exit__(self, *exc):
+        self.tool("pg_ctl", "-D", self.datadir, "-m", "fast", "-w", "stop")
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def tool(self, name, *args):
+        subprocess.run([os.path.join(self.bindir, name), *args], check=True, stdout=subprocess.DEVNULL)
+
+
+def seed_materials(credentials, materials, drop_existing=False):
+    """
+    (Re)creates public.allergen_info with materials synthetic rows. An
+    existing table with rows is only dropped when drop_existing is set.
+    """
+    conn = psycopg2.connect(port=APP_PORT, **credentials)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('public.allergen_info') IS NOT NULL")
+            if cursor.fetchone()[0] and not drop_existing:
+                cursor.execute("SELECT EXISTS (SELECT 1 FROM public.allergen_info)")
+                if cursor.fetchone()[0]:
+                    raise SystemExit("public.allergen_info already has rows; "
+                                     "pass --drop-existing to replace them or use another database")
+            cursor.execute("DROP TABLE IF EXISTS public.allergen_info")
+            cursor.execute("""
+                CREATE TABLE public.allergen_info (
+                    material_no text PRIMARY KEY, ingredients text, allergen text,
+                    allergen_may_contain text, nutritional_information text)
+            """)
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(make_rows(materials))
+            buffer.seek(0)
+            cursor.copy_expert("COPY public.allergen_info FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute("ANALYZE public.allergen_info")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def recipe_file(session, materials, db_materials, missing_share=0.05):
+    """A recipe CSV drawn from the seeded materials, with a few numbers the database does not know."""
+    rnd = random.Random(session)
+    found = rnd.sample(range(FIRST_MATERIAL, FIRST_MATERIAL + db_materials), min(materials, db_materials))
+    missing = [FIRST_MATERIAL + db_materials + rnd.randrange(10**6) for _ in range(int(materials * missing_share))]
+    lines = ["material_no,weight"] + [f"{m},{rnd.randint(1, 500)}" for m in found + missing]
+    return f"session-{session}.csv", "\n".join(lines).encode(), "text/csv"
+
+
+def run_session(session, credentials, args):
+    """
+    Opens the app, enters the credentials, uploads a recipe and times the
+    rerun that renders the results. Returns (app, seconds, errors); a run
+    that shows no results table counts as an error.
+    """
+    at = AppTest.from_file(APP, default_timeout=args.timeout)
+    at.run()
+    labels = {"DB Username": credentials["user"], "DB Password": credentials["password"],
+              "DB Host": credentials["host"], "DB Name": credentials["dbname"]}
+    for widget in at.text_input:
+        if widget.label in labels:
+            widget.set_value(labels[widget.label])
+    at.file_uploader[0].set_value([recipe_file(session, args.file_materials, args.db_materials)])
+    started = time.perf_counter()
+    at.run()
+    elapsed = time.perf_counter() - started
+    errors = [e.message for e in at.exception] + [e.value for e in at.error]
+    errors += [w.value for w in at.warning if "No data found" in w.value]
+    if not errors and not len(at.dataframe):
+        errors.append("no results rendered")
+    return at, elapsed, errors
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_test(credentials, args):
+    counter = ConnectionCounter()
+    psycopg2.connect = counter
+    share_test_runtime()
+    share_script_cache()
+    sampler = ActivitySampler(lambda: counter.connect(port=APP_PORT, **credentials))
+    sampler.start()
+
+    baseline_rss = peak_rss_mb()
+    latencies, failures, sessions = [], [], []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = {pool.submit(run_session, i, credentials, args): i for i in range(args.sessions)}
+        for future in as_completed(futures):
+            try:
+                at, elapsed, errors = future.result()
+            except Exception as e:
+                failures.append((futures[future], repr(e)))
+                continue
+            # Sessions stay referenced until the end so peak RSS covers them all at once
+            sessions.append(at)
+            if errors:
+                failures.append((futures[future], errors[0]))
+            else:
+                latencies.append(elapsed)
+    wall = time.perf_counter() - started
+    sampler.stop()
+    psycopg2.connect = counter.connect
+
+    peak_rss = peak_rss_mb()
+    print(f"sessions    : {args.sessions} ({args.concurrency} concurrent), {len(failures)} failed")
+    if latencies:
+        p50, p90, p95, p99 = np.percentile(latencies, [50, 90, 95, 99])
+        print(f"latency (s) : p50 {p50:.3f}  p90 {p90:.3f}  p95 {p95:.3f}  p99 {p99:.3f}  max {max(latencies):.3f}")
+    print(f"throughput  : {len(latencies) / wall:.2f} sessions/s over {wall:.1f}s")
+    print(f"database    : {counter.opened} connections opened, peak {sampler.peak} concurrent backends")
+    print(f"memory      : peak RSS {peak_rss:.0f} MB, baseline {baseline_rss:.0f} MB, "
+          f"~{(peak_rss - baseline_rss) / max(len(sessions), 1):.1f} MB per session")
+    for session, error in failures[:5]:
+        print(f"  session {session}: {error}")
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--file-materials", type=int, default=500, help="materials per uploaded recipe")
+    parser.add_argument("--db-materials", type=int, default=100_000, help="rows seeded into allergen_info")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed per script run")
+    parser.add_argument("--dsn", help="use this database instead of a temporary cluster; it must listen on port "
+                                      f"{APP_PORT}, which main.py always connects to")
+    parser.add_argument("--seed", action="store_true", help="create allergen_info in the --dsn database")
+    parser.add_argument("--drop-existing", action="store_true",
+                        help="let --seed replace an allergen_info table that already has rows")
+    args = parser.parse_args()
+
+    if args.dsn:
+        dsn = psycopg2.extensions.parse_dsn(args.dsn)
+        credentials = {"user": dsn.get("user", ""), "password": dsn.get("password", ""),
+                       "host": dsn.get("host", ""), "dbname": dsn.get("dbname", "")}
+        if args.seed:
+            seed_materials(credentials, args.db_materials, drop_existing=args.drop_existing)
+        ok = load_test(credentials, args)
+    else:
+        with LocalPostgres(max_connections=max(100, 4 * args.concurrency)) as credentials:
+            seed_materials(credentials, args.db_materials)
+            ok = load_test(credentials, args)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,27 @@
 import streamlit as st
 import pandas as pd
-import re
 import psycopg2
+import psycopg2.errors
+from psycopg2 import sql
+import functools
+import os
+import tempfile
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from materials import (
+    ADMISSION_POLL_SECONDS, EXPORT_DATASETS, EXPORT_FORMATS, FETCH_BATCH_SIZE, PAGE_SIZES, SEARCH_SCOPES,
+    SORT_COLUMNS, AdmissionController, LookupGenerations, LookupSuperseded, MaterialStore, NutritionTotals, TableIndex,
+    expand_bom, expand_uploads, export_batches, field_canonicalizers, materials_with_allergens, merge_weights,
+    optimize_weights, read_recipe_file, recipe_summary, records_to_arrow, validation_report, write_export,
+)
 
 st.sidebar.header("Database Credentials")
 DB_USERNAME = st.sidebar.text_input("DB Username")
 DB_PASSWORD = st.sidebar.text_input("DB Password", type="password")
 DB_HOST = st.sidebar.text_input("DB Host")
 DB_NAME = st.sidebar.text_input("DB Name")
+BOM_TABLE = st.sidebar.text_input(
+    "BOM Table", help="Optional (parent, child, quantity) table, quantity in g of child per 100 g of parent")
 
 
 # ---------------- DB CONNECTION ----------------
@@ -28,84 +42,444 @@ if st.sidebar.button("Connect to Database"):
         st.sidebar.error(f"❌ Connection Failed: {str(e)}")
 
 # ---------------- HELPERS ----------------
-def fetch_material_info(material_nos):
+LOOKUP_TIMEOUT_SECONDS = 60
+
+
+def fetch_material_info(material_nos, on_connect=None):
+    """
+    Looks up the given material numbers and returns the rows as an Arrow
+    table, decoded batch by batch as they come off the cursor. The query
+    is cancelled server-side after LOOKUP_TIMEOUT_SECONDS; on_connect(conn)
+    is called before it starts so callers can cancel it sooner, and
+    on_connect(None) before the connection is closed.
+    """
+    material_nos = tuple(dict.fromkeys(material_nos))
+    if not material_nos:
+        return records_to_arrow([])
+
     conn = get_db_connection()
-    cursor = conn.cursor()
-    ids_str = "', '".join(material_nos)
-    query = f"""
-        SELECT material_no, ingredients, allergen, allergen_may_contain, nutritional_information
-        FROM public.allergen_info
-        WHERE material_no IN ('{ids_str}');
+    try:
+        if on_connect is not None:
+            on_connect(conn)
+        cursor = conn.cursor()
+        cursor.execute("SET statement_timeout = %s", (LOOKUP_TIMEOUT_SECONDS * 1000,))
+        cursor.execute("""
+            SELECT material_no, ingredients, allergen, allergen_may_contain, nutritional_information
+            FROM public.allergen_info
+            WHERE material_no IN %s;
+        """, (material_nos,))
+        return records_to_arrow(iter(lambda: cursor.fetchmany(FETCH_BATCH_SIZE), []))
+    finally:
+        if on_connect is not None:
+            on_connect(None)
+        conn.close()
+
+
+# ---------------- CANONICALIZATION ----------------
+@st.cache_resource
+def list_canonicalizers():
+    """Process-wide canonicalizers so their per-token caches are shared across sessions."""
+    return field_canonicalizers()
+
+
+# ---------------- UPLOADS ----------------
+MAX_READ_WORKERS = 8
+
+
+@st.cache_resource
+def read_executor():
+    """Process-wide worker pool for reading uploaded recipe files."""
+    return ThreadPoolExecutor(max_workers=MAX_READ_WORKERS, thread_name_prefix="upload")
+
+
+def read_recipes(files, on_progress=None):
+    """
+    Reads all (name, bytes) recipe files concurrently. Returns {name: recipe}
+    in upload order; a file that fails to parse gets an 'error' entry.
+    """
+    futures = {read_executor().submit(read_recipe_file, name, data): name for name, data in files}
+    recipes = dict.fromkeys(name for name, _ in files)
+    for done, future in enumerate(as_completed(futures), start=1):
+        try:
+            recipes[futures[future]] = future.result()
+        except Exception as e:
+            recipes[futures[future]] = {"error": str(e)}
+        if on_progress:
+            on_progress(done, len(futures))
+    return recipes
+
+
+def cached_recipes(uploaded_files, on_progress=None):
+    """Reads the uploaded files once per distinct set of uploads in this session."""
+    key = tuple(uploaded.file_id for uploaded in uploaded_files)
+    cached = st.session_state.get("recipes")
+    if cached is None or cached[0] != key:
+        cached = st.session_state["recipes"] = (key, read_recipes(expand_uploads(uploaded_files), on_progress))
+    return cached[1]
+
+
+# ---------------- BILL OF MATERIALS ----------------
+def fetch_bom_tree(material_nos, bom_table, on_connect=None):
+    """
+    Resolves material_nos and every sub-assembly below them in one recursive
+    query. Returns (table, found, edges): the raw allergen_info rows of all
+    nodes with RAW_COLUMNS (nulls for nodes without a row), the nodes that
+    have an allergen_info row, and {parent: (children, quantities)}.
+    UNION keeps each node once, so cycles in the BOM terminate. The tree
+    keeps BOM keys in the BOM's own column type so parent lookups can use
+    its index, and joins allergen_info without casts when the key types
+    match. on_connect is called as in fetch_material_info().
+    """
+    material_nos = list(dict.fromkeys(material_nos))
+    if not material_nos:
+        return records_to_arrow([]), set(), {}
+
+    bom = sql.Identifier(*bom_table.strip().split("."))
+    conn = get_db_connection()
+    try:
+        if on_connect is not None:
+            on_connect(conn)
+        cursor = conn.cursor()
+        cursor.execute("SET statement_timeout = %s", (LOOKUP_TIMEOUT_SECONDS * 1000,))
+        cursor.execute("""
+            SELECT (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                    WHERE attrelid = %s::regclass AND attname = 'parent' AND NOT attisdropped),
+                   (SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                    WHERE attrelid = 'public.allergen_info'::regclass AND attname = 'material_no' AND NOT attisdropped);
+        """, (bom.as_string(conn),))
+        key_type, info_type = cursor.fetchone()
+        if key_type is None:
+            raise ValueError(f"BOM table {bom_table} has no parent column")
+        if info_type == key_type:
+            info_join = sql.SQL("a.material_no = t.material_no")
+        else:
+            info_join = sql.SQL("a.material_no::text = t.material_no::text")
+        cursor.execute(sql.SQL("""
+            WITH RECURSIVE tree(material_no) AS (
+                SELECT unnest(%s::{key_type}[])
+                UNION
+                SELECT b.child::{key_type} FROM tree t JOIN {bom} b ON b.parent = t.material_no
+            )
+            SELECT t.material_no::text, a.ingredients, a.allergen, a.allergen_may_contain, a.nutritional_information,
+                   a.material_no IS NOT NULL, c.children, c.quantities
+            FROM tree t
+            LEFT JOIN public.allergen_info a ON {info_join}
+            LEFT JOIN LATERAL (
+                SELECT array_agg(b.child::text) AS children, array_agg(b.quantity::float8) AS quantities
+                FROM {bom} b WHERE b.parent = t.material_no
+            ) c ON true;
+        """).format(bom=bom, key_type=sql.SQL(key_type), info_join=info_join), (material_nos,))
+        rows = cursor.fetchall()
+    finally:
+        if on_connect is not None:
+            on_connect(None)
+        conn.close()
+    table = records_to_arrow([[row[:5] for row in rows]] if rows else [])
+    found = {row[0] for row in rows if row[5]}
+    edges = {row[0]: (row[6], row[7]) for row in rows if row[6]}
+    return table, found, edges
+
+
+# ---------------- ADMISSION CONTROL ----------------
+MAX_CONCURRENT_LOOKUPS = 4
+
+
+@st.cache_resource
+def lookup_admission():
+    """Process-wide admission controller for database lookups."""
+    return AdmissionController(MAX_CONCURRENT_LOOKUPS)
+
+
+@st.cache_resource
+def lookup_executor():
+    """Process-wide pool the admitted lookups run on, one thread per slot."""
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOOKUPS, thread_name_prefix="lookup")
+
+
+def run_lookup(material_nos, fetch=fetch_material_info):
     """
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    conn.close()
-    columns = ["material_no", "ingredients", "allergen", "allergen_may_contain", "nutritional_information"]
-    return pd.DataFrame(rows, columns=columns)
+    fetch(material_nos, on_connect) under admission control. The queue position is
+    shown while waiting. The query runs on a worker so the script thread
+    keeps reaching Streamlit calls, where a rerun interrupts it; the
+    interrupted query is then cancelled instead of running to completion.
+    Lookups from earlier runs of this session still in flight are cancelled
+    as soon as a newer one starts.
+    """
+    lookups = st.session_state.setdefault("lookups", LookupGenerations())
+    generation = lookups.start()
+
+    status = st.empty()
+    admission = lookup_admission()
+    admission.acquire(lambda position: status.info(
+        f"⏳ Waiting for a database slot: position {position} in queue"))
+    lookups.track(generation)
+
+    def lookup():
+        try:
+            return fetch(material_nos, on_connect=functools.partial(lookups.connected, generation))
+        finally:
+            lookups.finish(generation)
+            admission.release()
 
+    try:
+        future = lookup_executor().submit(lookup)
+    except BaseException:
+        lookups.finish(generation)
+        admission.release()
+        raise
+    try:
+        while not wait([future], timeout=ADMISSION_POLL_SECONDS).done:
+            # Any Streamlit call is a point where a pending rerun stops this script
+            status.caption("🔎 Querying the material database...")
+    except BaseException:
+        lookups.cancel_before(generation + 1)
+        raise
+    status.empty()
+    try:
+        return future.result()
+    except psycopg2.errors.QueryCanceled:
+        if not lookups.is_current(generation):
+            raise LookupSuperseded("a newer lookup replaced this one")
+        raise TimeoutError(f"the material lookup took longer than {LOOKUP_TIMEOUT_SECONDS}s and was cancelled")
+
+
+# ---------------- DATA VIEW ----------------
+def render_data_view(index, key="data_view"):
+    """Paginated, searchable and sortable view over the parsed lookup."""
+    search_col, scope_col, sort_col, order_col = st.columns([3, 2, 2, 1])
+    query = search_col.text_input("🔍 Search", key=f"{key}_query", placeholder="Material no, allergen or ingredient")
+    scope = scope_col.selectbox("Search in", list(SEARCH_SCOPES), key=f"{key}_scope")
+    sort_by = sort_col.selectbox("Sort by", list(SORT_COLUMNS), key=f"{key}_sort")
+    descending = order_col.toggle("Desc", key=f"{key}_desc")
+
+    size_col, page_col, info_col = st.columns([1, 1, 3])
+    page_size = size_col.selectbox("Rows per page", PAGE_SIZES, key=f"{key}_page_size")
+    mask = index.matching_rows(query, SEARCH_SCOPES[scope])
+    total = int(mask.sum())
+    n_pages = max(1, -(-total // page_size))
+    # A narrower search can leave the stored page past the end
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = page_col.number_input("Page", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+
+    table = index.page(mask, SORT_COLUMNS[sort_by], descending, page, page_size)
+    first = (page - 1) * page_size
+    info_col.caption(f"Showing {first + 1 if total else 0}–{first + table.num_rows} of {total:,} materials")
+    st.dataframe(table, use_container_width=True, hide_index=True)
+    st.caption("Parsed data, not the label text: lists show lowercase canonical ingredient names without "
+               "percentages or nesting, and '<' marks nutrient values declared as upper bounds.")
+
+
+def cached_lookup(material_nos):
+    """
+    Returns (MaterialStore, TableIndex, BOM warnings) for material_nos. Every
+    widget interaction reruns the script, so the lookup is kept in the
+    session and only refetched when the materials or the database change.
+    With a BOM table set, sub-assemblies are expanded, see expand_bom().
+    """
+    key = (DB_HOST, DB_NAME, DB_USERNAME, BOM_TABLE, tuple(material_nos))
+    cached = st.session_state.get("lookup")
+    if cached is None or cached[0] != key:
+        warnings = []
+        if BOM_TABLE.strip():
+            table, found, edges = run_lookup(material_nos, functools.partial(fetch_bom_tree, bom_table=BOM_TABLE))
+            nodes = MaterialStore.from_arrow(table, list_canonicalizers())
+            store, cycles, unquantified = expand_bom(nodes, found, edges, material_nos)
+            warnings = [f"🔁 BOM cycle ignored: {cycle}" for cycle in cycles]
+            warnings += [f"⚖️ BOM quantity missing, left out of nutrient totals: {edge}" for edge in unquantified]
+        else:
+            store = MaterialStore.from_arrow(run_lookup(material_nos), list_canonicalizers())
+        cached = st.session_state["lookup"] = (key, store, TableIndex(store), warnings)
+    return cached[1], cached[2], cached[3]
 
-def parse_nutrition_string(text):
+
+# ---------------- WEIGHT EDITING ----------------
+def apply_weight_edits(key):
     """
-    Parses nutrition string like:
-    'Energy: 342 kcal, protein: 8.1g, carbohydrate: 73.8g, fat: 3.8g sodium 15mg'
-    into a proper dictionary.
+    data_editor callback: pushes the edited weights into the session's
+    NutritionTotals. A cleared cell falls back to the uploaded weight.
     """
-    if not text or not isinstance(text, str):
-        return {}
-
-    nutrition = {}
-    # Split on comma and space to get individual parts
-    parts = re.split(r'[;,]', text)
-    for part in parts:
-        # Match things like: "Protein: 8.1g" or "fat 3.8g"
-        match = re.match(r"\s*([\w\s\-]+?)[:\s]+([<\d\.]+)\s*([a-zA-Zμ%]*)", part.strip())
-        if match:
-            key, val, unit = match.groups()
-            key = key.strip().capitalize()
-            val = val.strip()
-            nutrition[key] = f"{val} {unit}".strip()
-    return nutrition
-
-
-def parse_fields(df):
-    def to_list(x):
-        if pd.isna(x) or not x:
-            return []
-        # split by comma or 'and'
-        return [i.strip().lower() for i in re.split(r',| and ', str(x)) if i.strip()]
-
-    df['ingredients'] = df.get('ingredients', '').apply(to_list)
-    df['allergen'] = df.get('allergen', '').apply(to_list)
-    df['allergen_may_contain'] = df.get('allergen_may_contain', '').apply(to_list)
-    df['nutritional_information'] = df['nutritional_information'].apply(parse_nutrition_string)
-    return df
-
-
-def calculate_nutrition(df, weights=None):
-    total = {}
-    units = {}
-
-    for _, row in df.iterrows():
-        nutrition = row['nutritional_information']  # or 'nutritional_information'
-        material_no = row['material_no']
-        weight = weights.get(material_no, 100) if weights else 100
-
-        for k, v in nutrition.items():
-            # Extract numeric value and unit
-            match = re.match(r"([<\d\.]+)\s*([a-zA-Zμ%]*)", str(v).strip())
-            if not match:
-                continue
-            val_str, unit = match.groups()
-            try:
-                val = float(val_str.replace("<", "").strip())
-            except:
-                val = 0.0
-
-            scaled_val = val * (weight / 100.0)
-            total[k] = total.get(k, 0.0) + scaled_val
-            units[k] = unit or ("kcal" if "Energy" in k else "g")
-
-    return {k: f"{v:.2f} {units[k]}" for k, v in total.items()}
+    state = st.session_state[key]
+    edited = st.session_state[f"{key}_editor"]["edited_rows"]
+    base = state["frame"]
+    rows = [row for row, change in edited.items() if "weight" in change]
+    uploaded = base["weight"].to_numpy()
+    new_weights = [uploaded[row] if edited[row]["weight"] is None else edited[row]["weight"] for row in rows]
+    state["totals"].update(base["material_no"].to_numpy()[rows], new_weights)
+
+
+def render_weight_editor(store, weights, key="weights"):
+    """
+    Editable weights grid for the current lookup. Returns the NutritionTotals
+    reflecting every edit made so far.
+    """
+    signature = (id(store), hash(tuple(weights.items())))
+    state = st.session_state.get(key)
+    if state is None or state["signature"] != signature or st.session_state.get(f"{key}_reset"):
+        # Dropping the editor's state makes it start again from the uploaded weights
+        st.session_state.pop(f"{key}_editor", None)
+        frame = pd.DataFrame({"material_no": list(weights), "weight": [float(w) for w in weights.values()]})
+        frame["in database"] = frame["material_no"].isin(store.material_no.categories)
+        state = st.session_state[key] = {
+            "signature": signature, "frame": frame, "totals": NutritionTotals(store, weights),
+        }
+
+    st.data_editor(
+        state["frame"], key=f"{key}_editor", on_change=apply_weight_edits, args=(key,),
+        disabled=["material_no", "in database"], hide_index=True, use_container_width=True,
+        column_config={"weight": st.column_config.NumberColumn("weight (g)", min_value=0.0, format="%.2f",
+                                                              required=True)},
+    )
+    st.button("↩️ Reset weights", key=f"{key}_reset")
+    return state["totals"]
+
+
+# ---------------- OPTIMIZER ----------------
+def render_optimizer(store, totals, key="optimizer"):
+    """Targets form and result table for optimize_weights()."""
+    targets_frame = pd.DataFrame({
+        "nutrient": store.nutrient_names,
+        "unit": store.nutrient_units,
+        "min": [None] * len(store.nutrient_names),
+        "max": [None] * len(store.nutrient_names),
+    }).astype({"min": float, "max": float})
+
+    mass_col, claim_col = st.columns([1, 2])
+    total_mass = mass_col.number_input(
+        "Total mass (g)", min_value=0.0, value=float(totals.weights.sum()), key=f"{key}_mass")
+    claim = claim_col.multiselect(
+        "Allergen-free claim",
+        sorted(set(store.unique_tokens("allergen")) | set(store.unique_tokens("allergen_may_contain"))),
+        key=f"{key}_claim")
+    targets = st.data_editor(
+        targets_frame, key=f"{key}_targets", disabled=["nutrient", "unit"], hide_index=True,
+        use_container_width=True)
+
+    if st.button("🎯 Optimize weights", key=f"{key}_run"):
+        bounds = {
+            row.nutrient: (None if pd.isna(row.min) else row.min, None if pd.isna(row.max) else row.max)
+            for row in targets.itertuples()
+        }
+        excluded = materials_with_allergens(store, claim)
+        proposed, message = optimize_weights(totals, total_mass, bounds, excluded)
+        st.session_state[key] = {"proposed": proposed, "message": message, "excluded": excluded}
+
+    result = st.session_state.get(key)
+    if result is None:
+        return
+    if result["proposed"] is None:
+        st.error(f"❌ No recipe meets these targets: {result['message']}")
+        return
+    proposed = result["proposed"]
+    st.success(f"✅ {result['message']}")
+    st.dataframe(pd.DataFrame({
+        "material_no": totals.materials,
+        "current (g)": totals.weights.round(2),
+        "proposed (g)": proposed.round(2),
+        "excluded by claim": result["excluded"],
+    }), use_container_width=True, hide_index=True)
+    st.dataframe(pd.DataFrame({
+        "nutrient": store.nutrient_names,
+        "current": (totals.weights @ totals.per_gram).round(2),
+        "proposed": (proposed @ totals.per_gram).round(2),
+        "unit": store.nutrient_units,
+    }), use_container_width=True, hide_index=True)
+    if st.button("✔️ Apply proposed weights", key=f"{key}_apply"):
+        apply_proposed_weights(totals.materials, proposed)
+        st.session_state.pop(key)
+        st.rerun()
+
+
+def apply_proposed_weights(material_nos, proposed, key="weights"):
+    """Loads optimizer output into the weights grid and its running totals."""
+    state = st.session_state[key]
+    frame = state["frame"].copy()
+    positions = pd.Index(frame["material_no"]).get_indexer(material_nos)
+    frame.loc[positions[positions >= 0], "weight"] = proposed[positions >= 0]
+    state["frame"] = frame
+    state["totals"].update(material_nos, proposed)
+    # The grid restarts from the new frame
+    st.session_state.pop(f"{key}_editor", None)
+
+
+# ---------------- EXPORT ----------------
+@st.cache_resource
+def export_executor():
+    """Process-wide worker pool so exports never run on the script thread."""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="export")
+
+
+def remove_export_file(future, path):
+    """Deletes an export's temp file now, or once a job still writing it has finished."""
+    def remove(_=None):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    if future.cancel() or future.done():
+        remove()
+    else:
+        future.add_done_callback(remove)
+
+
+class ExportFile:
+    """
+    Owns the temp file of one export. discard() deletes it; if the session
+    ends first, the file goes when its state is garbage collected or, at
+    the latest, when the process exits.
+    """
+
+    def __init__(self, future, path):
+        self.path = path
+        self.discard = weakref.finalize(self, remove_export_file, future, path)
+
+
+def start_export(store, dataset, fmt, weights, key="export"):
+    previous = st.session_state.pop(key, None)
+    if previous is not None:
+        previous["file"].discard()
+
+    suffix, mime = EXPORT_FORMATS[fmt]
+    handle, path = tempfile.mkstemp(prefix="allergen_export_", suffix=suffix)
+    os.close(handle)
+    future = export_executor().submit(write_export, export_batches(store, dataset, weights), fmt, path)
+    st.session_state[key] = {
+        "future": future, "file": ExportFile(future, path), "mime": mime,
+        "file_name": f"{dataset.lower().replace(' ', '_')}{suffix}",
+    }
+
+
+@st.fragment(run_every="1s")
+def export_progress(key="export"):
+    """Polls a running export and reruns the app once it has finished."""
+    job = st.session_state.get(key)
+    if job is None or job["future"].done():
+        st.rerun()
+    st.info(f"⏳ Preparing {job['file_name']}...")
+
+
+def render_export(store, weights, key="export"):
+    dataset_col, format_col, button_col = st.columns([2, 1, 1])
+    dataset = dataset_col.selectbox("Dataset", EXPORT_DATASETS, key=f"{key}_dataset")
+    fmt = format_col.selectbox("Format", list(EXPORT_FORMATS), key=f"{key}_format")
+    button_col.markdown("<br>", unsafe_allow_html=True)
+    if button_col.button("📦 Prepare export", key=f"{key}_start", use_container_width=True):
+        start_export(store, dataset, fmt, weights, key)
+
+    job = st.session_state.get(key)
+    if job is None:
+        return
+    if not job["future"].done():
+        export_progress(key)
+    elif job["future"].exception() is not None:
+        st.error(f"❌ Export failed: {job['future'].exception()}")
+    else:
+        with open(job["file"].path, "rb") as f:
+            st.download_button(
+                f"⬇️ Download {job['file_name']} ({job['future'].result():,} rows)",
+                f, file_name=job["file_name"], mime=job["mime"], key=f"{key}_download",
+            )
 
 
 # ---------------- STREAMLIT UI ----------------
@@ -835,51 +1209,66 @@ st.html("""
 </div>
 """)
 
-uploaded_file = st.file_uploader("📎 Upload CSV or Excel", type=["csv", "xlsx"])
+uploaded_files = st.file_uploader(
+    "📎 Upload CSV, Excel or ZIP files", type=["csv", "xlsx", "zip"], accept_multiple_files=True)
 
 
-if uploaded_file:
+if uploaded_files:
     try:
         # Processing indicator
         with st.spinner('🔄 Processing your data...'):
-            if uploaded_file.name.endswith(".csv"):
-                df_input = pd.read_csv(uploaded_file)
-            else:
-                df_input = pd.read_excel(uploaded_file)
-
-        if "material_no" not in df_input.columns:
-            st.error("❌ The file must contain a 'material_no' column.")
+            progress = st.empty()
+            recipes = cached_recipes(uploaded_files, lambda done, total: progress.progress(
+                done / total, text=f"📂 Read {done} of {total} files"))
+            progress.empty()
+
+        report = validation_report(recipes)
+        if not report.empty:
+            rejected = int((report["severity"] == "error").sum())
+            st.warning(f"⚠️ {rejected} rows were rejected and {len(report) - rejected} rows were "
+                       "corrected while validating the uploads.")
+            st.download_button("⬇️ Download validation report", report.to_csv(index=False).encode("utf-8"),
+                               file_name="validation_report.csv", mime="text/csv", key="validation_report")
+
+        for name, recipe in recipes.items():
+            if "error" in recipe:
+                st.error(f"❌ {name}: {recipe['error']}")
+        recipes = {name: recipe for name, recipe in recipes.items() if "error" not in recipe}
+
+        if not recipes:
+            st.error("❌ None of the uploaded files could be used.")
         else:
-            material_nos = df_input["material_no"].astype(str).tolist()
-            weights = dict(
-                zip(df_input["material_no"].astype(str), df_input.get("weight", pd.Series([100] * len(df_input)))))
+            # One deduplicated lookup covers every file
+            material_nos = list(dict.fromkeys(m for recipe in recipes.values() for m in recipe["material_nos"]))
+            weights = merge_weights(recipes)
 
             # Fetch and process data
             with st.spinner('📊 Analyzing material information...'):
-                df_raw = fetch_material_info(material_nos)
-                df_parsed = parse_fields(df_raw)
+                # Only the compact store is kept; the raw text is rebuilt for display
+                store, table_index, bom_warnings = cached_lookup(material_nos)
+            for warning in bom_warnings:
+                st.warning(warning)
 
             # Display raw data
             st.markdown("""
             <div class="data-table-container">
                 <div class="table-header">
                     <span>📋</span>
-                    <span>Material Data Overview</span>
+                    <span>Material Data Overview (parsed)</span>
                 </div>
             </div>
             """, unsafe_allow_html=True)
 
-            if not df_raw.empty:
-                st.dataframe(df_raw, use_container_width=True)
+            if len(store):
+                render_data_view(table_index)
             else:
                 st.warning("No data found for the provided material numbers.")
 
             # Process results if data exists
-            if not df_parsed.empty:
-                all_ingredients = sorted(set(i for lst in df_parsed['ingredients'] for i in lst if i))
-                all_allergens = sorted(set(a for lst in df_parsed['allergen'] for a in lst if a))
-                may_contain = sorted(set(a for lst in df_parsed['allergen_may_contain'] for a in lst if a))
-                nutrition = calculate_nutrition(df_parsed, weights)
+            if len(store):
+                all_ingredients = store.unique_tokens('ingredients')
+                all_allergens = store.unique_tokens('allergen')
+                may_contain = store.unique_tokens('allergen_may_contain')
 
                 # Results grid
                 st.markdown('<div class="results-grid">', unsafe_allow_html=True)
@@ -928,6 +1317,18 @@ if uploaded_file:
 
                 st.markdown('</div>', unsafe_allow_html=True)  # Close results grid
 
+                # Weights editor
+                st.markdown("""
+                <div class="data-table-container">
+                    <div class="table-header">
+                        <span>⚖️</span>
+                        <span>Recipe Weights</span>
+                    </div>
+                </div>
+                """, unsafe_allow_html=True)
+                totals = render_weight_editor(store, weights)
+                nutrition = totals.formatted()
+
                 # Nutrition section
                 if nutrition:
                     st.markdown("""
@@ -949,6 +1350,33 @@ if uploaded_file:
 
                     st.markdown('</div></div>', unsafe_allow_html=True)  # Close nutrition section
 
+                # Per-file results
+                if len(recipes) > 1:
+                    st.markdown("""
+                    <div class="data-table-container">
+                        <div class="table-header">
+                            <span>🗂️</span>
+                            <span>Per-File Results</span>
+                        </div>
+                    </div>
+                    """, unsafe_allow_html=True)
+                    st.dataframe(recipe_summary(store, recipes), use_container_width=True, hide_index=True)
+
+                # Optimizer section
+                with st.expander("🎯 Recipe Optimizer"):
+                    render_optimizer(store, totals)
+
+                # Export section
+                st.markdown("""
+                <div class="data-table-container">
+                    <div class="table-header">
+                        <span>📥</span>
+                        <span>Export Results</span>
+                    </div>
+                </div>
+                """, unsafe_allow_html=True)
+                render_export(store, totals.weight_map())
+
     except Exception as e:
         st.error(f"❌ Error processing file: {str(e)}")
         st.markdown("""
@@ -957,7 +1385,7 @@ if uploaded_file:
             <ul style="text-align: left; margin-top: 1rem;">
                 <li>File must contain a 'material_no' column</li>
                 <li>Optionally include a 'weight' column for weighted calculations</li>
-                <li>Supported formats: CSV (.csv) and Excel (.xlsx)</li>
+                <li>Supported formats: CSV (.csv), Excel (.xlsx) and ZIP archives of those</li>
                 <li>Ensure data is properly formatted without extra spaces</li>
             </ul>
         </div>
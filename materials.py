@@ -0,0 +1,1319 @@
+"""
+Parsing, storage and analysis of allergen_info records, shared by the
+Streamlit app in main.py and the benchmark and load-test scripts. Nothing
+here touches Streamlit or opens database connections.
+"""
+import functools
+import io
+import itertools
+import os
+import re
+import sys
+import threading
+import zipfile
+from array import array
+from collections import deque
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from scipy.optimize import linprog
+
+
+# ---------------- PARSING ----------------
+LIST_FIELDS = ["ingredients", "allergen", "allergen_may_contain"]
+RAW_COLUMNS = ["material_no"] + LIST_FIELDS + ["nutritional_information"]
+FETCH_BATCH_SIZE = 10_000
+
+
+def records_to_arrow(batches):
+    """
+    Transposes batches of raw lookup tuples into an Arrow table of string
+    columns, one RecordBatch per input batch.
+    """
+    schema = pa.schema([(name, pa.string()) for name in RAW_COLUMNS])
+    record_batches = [
+        pa.RecordBatch.from_arrays([pa.array(col).cast(pa.string()) for col in zip(*batch)], schema=schema)
+        for batch in batches
+        if batch
+    ]
+    return pa.Table.from_batches(record_batches, schema=schema)
+
+
+def parse_nutrition_string(text):
+    """
+    Parses nutrition string like:
+    'Energy: 342 kcal, protein: 8.1g, carbohydrate: 73.8g, fat: 3.8g sodium 15mg'
+    into a proper dictionary.
+    """
+    if not text or not isinstance(text, str):
+        return {}
+
+    nutrition = {}
+    # Split on comma and space to get individual parts
+    parts = re.split(r'[;,]', text)
+    for part in parts:
+        # Match things like: "Protein: 8.1g" or "fat 3.8g"
+        match = re.match(r"\s*([\w\s\-]+?)[:\s]+([<\d\.]+)\s*([a-zA-Zμ%]*)", part.strip())
+        if match:
+            key, val, unit = match.groups()
+            key = key.strip().capitalize()
+            val = val.strip()
+            nutrition[key] = f"{val} {unit}".strip()
+    return nutrition
+
+
+TOKEN_SEPARATOR = r"(?:,|;| and )"
+TOKEN_TRIM = " \t\r\n."
+PERCENTAGE = r"\s*[\d.,]*\s*%"
+# Brackets and every separator other than ',' - rewritten to ',' before a literal split
+BRACKETS_AND_SEPARATORS = r"[;()\[\]{}]| and "
+# A closing bracket followed by more text before the next separator, as in 'milk (skimmed) powder'
+BRACKET_SUFFIX = r"[)\]}][\s()\[\]{}]*[^\s,;()\[\]{}]"
+SEPARATOR_PATTERN = re.compile(TOKEN_SEPARATOR)
+BRACKET_PATTERN = re.compile(r"([()\[\]{}])")
+PERCENT_DIGITS = "0123456789.,"
+
+
+def tokenize_ingredients(text):
+    """
+    Splits a declaration like 'Chocolate 20% (sugar, cocoa butter, milk powder 3,5%), salt'
+    into a flat list of lowercase tokens and a parallel list of parent links:
+    (['chocolate', 'sugar', 'cocoa butter', 'milk powder', 'salt'], [-1, 0, 0, 0, -1]).
+    Percentages are dropped, so decimal commas inside them never split a token,
+    and a closing bracket without a matching opening one separates tokens.
+    """
+    if not isinstance(text, str):
+        if text is None or pd.isna(text):
+            return [], []
+        text = str(text)
+
+    text = text.lower()
+    if "%" in text:
+        # Drop the number in front of every '%' (plain str ops are far cheaper than a regex here)
+        parts = text.split("%")
+        text = "".join([part.rstrip().rstrip(PERCENT_DIGITS).rstrip() for part in parts[:-1]] + parts[-1:])
+    if not BRACKET_PATTERN.search(text):
+        tokens = [token for piece in SEPARATOR_PATTERN.split(text) if (token := piece.strip(TOKEN_TRIM))]
+        return tokens, [-1] * len(tokens)
+
+    # re.split with a capturing group alternates text segments and brackets
+    parts = BRACKET_PATTERN.split(text)
+
+    tokens, parents = [], []
+    stack = [-1]        # parent link for the current nesting depth
+    closed = -1         # token whose bracket just closed; text right after it extends it
+    for i in range(0, len(parts), 2):
+        pieces = SEPARATOR_PATTERN.split(parts[i])
+        # owner is the token a following opening bracket belongs to
+        owner = closed
+        first = pieces[0].strip(TOKEN_TRIM)
+        if closed >= 0:
+            if first:
+                tokens[closed] = f"{tokens[closed]} {first}"
+            pieces = pieces[1:]
+        if pieces:
+            owner = -1
+            parent = stack[-1]
+            for piece in pieces:
+                piece = piece.strip(TOKEN_TRIM)
+                if piece:
+                    tokens.append(piece)
+                    parents.append(parent)
+            if piece:
+                owner = len(tokens) - 1
+
+        closed = -1
+        if i + 1 < len(parts):
+            if parts[i + 1] in "([{":
+                stack.append(owner if owner >= 0 else stack[-1])
+            elif len(stack) > 1:
+                closed = stack.pop()
+    return tokens, parents
+
+
+def tokenize_column(column, with_parents=False):
+    """
+    Tokenizes an Arrow string column into the same flat tokens as
+    tokenize_ingredients(). Returns (tokens, row) arrays with one entry per
+    token, in row order, and with_parents also each token's parent link
+    within its row.
+
+    Flat tokens do not need parent links, so percentages are stripped and
+    brackets treated as separators by Arrow kernels over the whole column.
+    Only rows with text after a closing bracket, which extends the bracket's
+    owner, go through tokenize_ingredients(), or with_parents every row
+    with an opening bracket.
+    """
+    text = pc.replace_substring_regex(pc.utf8_lower(column), PERCENTAGE, "")
+    suffixed = pc.fill_null(pc.match_substring_regex(text, BRACKET_SUFFIX), False)
+    if with_parents:
+        suffixed = pc.or_(suffixed, pc.fill_null(pc.match_substring_regex(text, r"[(\[{]"), False))
+    flat = pc.replace_substring_regex(
+        pc.if_else(suffixed, pa.scalar(None, pa.string()), text), BRACKETS_AND_SEPARATORS, ",")
+    split = pc.split_pattern(flat, ",")
+    tokens = pc.utf8_trim(pc.list_flatten(split), characters=TOKEN_TRIM)
+    rows = pc.list_parent_indices(split).to_numpy()
+    parents = np.full(len(rows), -1, dtype=np.int32)
+
+    suffixed_rows = np.flatnonzero(suffixed.to_numpy(zero_copy_only=False))
+    if len(suffixed_rows):
+        row_tokens, row_parents = zip(*map(tokenize_ingredients, text.take(suffixed_rows).to_pylist()))
+        tokens = pa.concat_arrays([tokens, pa.array(list(itertools.chain.from_iterable(row_tokens)), pa.string())])
+        rows = np.concatenate([rows, np.repeat(suffixed_rows, [len(t) for t in row_tokens])])
+        parents = np.concatenate([parents, np.fromiter(itertools.chain.from_iterable(row_parents), dtype=np.int32,
+                                                       count=len(rows) - len(parents))])
+        order = np.argsort(rows, kind="stable")
+        tokens, rows, parents = tokens.take(order), rows[order], parents[order]
+
+    # Only flat rows have empty tokens, so dropping them leaves the parent links valid
+    keep = pc.not_equal(tokens, "")
+    keep_np = keep.to_numpy(zero_copy_only=False)
+    if with_parents:
+        return tokens.filter(keep), rows[keep_np], parents[keep_np]
+    return tokens.filter(keep), rows[keep_np]
+
+
+def parse_nutrient_value(value):
+    """
+    Splits a formatted nutrient value like '8.1 g' or '<0.5 g' into
+    (8.1, 'g'). Returns None when the value has no leading number.
+    """
+    match = re.match(r"([<\d\.]+)\s*([a-zA-Zμ%]*)", str(value).strip())
+    if not match:
+        return None
+    val_str, unit = match.groups()
+    try:
+        val = float(val_str.replace("<", "").strip())
+    except ValueError:
+        val = 0.0
+    return val, unit
+
+
+def default_nutrient_unit(key):
+    return "kcal" if "Energy" in key else "g"
+
+
+def format_nutrition(total, units):
+    return {k: f"{v:.2f} {units[k]}" for k, v in total.items()}
+
+
+# ---------------- CANONICALIZATION ----------------
+# Variant spelling -> canonical ingredient. Canonical names map to themselves implicitly.
+INGREDIENT_SYNONYMS = {
+    "plain flour": "wheat flour", "white flour": "wheat flour",
+    "white wheat flour": "wheat flour", "wheatflour": "wheat flour",
+    "wholemeal flour": "wholemeal wheat flour", "whole wheat flour": "wholemeal wheat flour",
+    "sucrose": "sugar", "cane sugar": "sugar", "beet sugar": "sugar", "granulated sugar": "sugar",
+    "sea salt": "salt", "sodium chloride": "salt", "table salt": "salt",
+    "canola oil": "rapeseed oil", "palm fat": "palm oil", "vegetable fat palm": "palm oil",
+    "corn starch": "maize starch", "cornstarch": "maize starch",
+    "skim milk powder": "skimmed milk powder", "nonfat dry milk": "skimmed milk powder",
+    "full cream milk powder": "whole milk powder", "dried whole milk": "whole milk powder",
+    "cocoa liquor": "cocoa mass", "cocoa solids": "cocoa mass",
+    "soy lecithin": "soya lecithin", "soybean lecithin": "soya lecithin", "lecithin soya": "soya lecithin",
+    "e322": "lecithin", "e330": "citric acid", "e300": "ascorbic acid", "e471": "mono- and diglycerides of fatty acids",
+    "e500": "sodium carbonates", "e500ii": "sodium bicarbonate", "sodium hydrogen carbonate": "sodium bicarbonate",
+    "baking soda": "sodium bicarbonate", "e450": "diphosphates", "e503": "ammonium carbonates",
+    "natural flavoring": "natural flavouring", "natural flavour": "natural flavouring",
+    "dextrose monohydrate": "dextrose", "glucose-fructose syrup": "glucose syrup",
+    "soy": "soya", "soybean": "soya", "soybeans": "soya", "soja": "soya",
+    "eggs": "egg", "whole egg": "egg", "hen egg": "egg",
+    "hazelnuts": "hazelnut", "almonds": "almond", "peanuts": "peanut", "groundnut": "peanut",
+}
+# Allergen claim variant -> allergen. Only applied to the allergen fields: an ingredient
+# list that declares lactose must keep saying lactose.
+ALLERGEN_SYNONYMS = {
+    "soy": "soya", "soybean": "soya", "soybeans": "soya", "soja": "soya",
+    "eggs": "egg", "whole egg": "egg", "hen egg": "egg",
+    "cow's milk": "milk", "milk protein": "milk", "lactose": "milk",
+    "hazelnuts": "hazelnut", "almonds": "almond", "peanuts": "peanut", "groundnut": "peanut",
+    "cereals containing gluten": "gluten", "sesame seeds": "sesame", "mustard seeds": "mustard",
+    "sulphites": "sulphur dioxide", "sulfites": "sulphur dioxide", "sulfur dioxide": "sulphur dioxide",
+    "crustacean": "crustaceans", "mollusc": "molluscs", "lupine": "lupin",
+}
+# Words that describe a treatment or a declaration detail rather than the ingredient itself
+INGREDIENT_QUALIFIERS = frozenset({
+    "fortified", "enriched", "organic", "bleached", "unbleached", "pasteurised", "pasteurized",
+    "min", "max", "approx", "contains", "including", "added", "e.g",
+})
+CANONICAL_CACHE_SIZE = 1_000_000
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def typo_budget(word):
+    """Edits a misspelt word may be away from a known one: none for short words, which are too easily another word."""
+    return 0 if len(word) < 4 else 1 if len(word) < 8 else 2
+
+
+def edit_distance(a, b, limit):
+    """
+    Levenshtein distance counting a swap of neighbours as one edit, or
+    limit + 1 as soon as it must exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+
+class Canonicalizer:
+    """
+    Maps ingredient tokens to canonical names.
+
+    A token is normalised (qualifier words dropped, whitespace collapsed),
+    then looked up in the synonym table, by word order ('flour wheat'), by
+    singular form, and finally as a misspelling of a known name: same
+    number of words, and only words that are not known words themselves may
+    differ, each by a few edits ('soya lecitin'). Candidates come from an
+    inverted trigram index. Anything else is left as it is, so 'wholemeal
+    oat flour' never becomes a wheat flour. Results are memoised per token,
+    so a corpus costs one lookup per distinct token.
+    """
+
+    def __init__(self, synonyms=None, qualifiers=INGREDIENT_QUALIFIERS):
+        synonyms = INGREDIENT_SYNONYMS if synonyms is None else synonyms
+        self.qualifiers = qualifiers
+        self.exact = {name: name for name in synonyms.values()}
+        self.exact.update(synonyms)
+        self.by_words = {" ".join(sorted(variant.split())): canonical for variant, canonical in self.exact.items()}
+        self.words = {word for name in self.exact for word in name.split()}
+
+        self.names = list(self.exact)
+        self.name_words = [name.split() for name in self.names]
+        self.index = {}
+        for i, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.index.setdefault(gram, []).append(i)
+        self.canonical = functools.lru_cache(maxsize=CANONICAL_CACHE_SIZE)(self._canonical)
+
+    def normalize(self, token):
+        words = [word for word in re.findall(r"[\w'\-.]+", token.lower()) if word.strip(".") not in self.qualifiers]
+        return " ".join(words).strip(" .")
+
+    def match(self, key, fuzzy=True):
+        """Canonical name for a normalised key, or None when nothing is close enough."""
+        if key in self.exact:
+            return self.exact[key]
+        by_words = self.by_words.get(" ".join(sorted(key.split())))
+        if by_words:
+            return by_words
+        for suffix in ("es", "s"):
+            if key.endswith(suffix) and key[:-len(suffix)] in self.exact:
+                return self.exact[key[:-len(suffix)]]
+        if not fuzzy:
+            return None
+
+        words = key.split()
+        # Only a word that is not a known word itself can be a misspelling of one
+        typos = [position for position, word in enumerate(words) if word not in self.words]
+        if not typos or not all(typo_budget(words[position]) for position in typos):
+            return None
+        grams = trigrams(key)
+        candidates = {i for gram in grams for i in self.index.get(gram, ())}
+        best, best_edits = None, None
+        for i in candidates:
+            candidate = self.name_words[i]
+            if len(candidate) != len(words) or any(
+                    a != b for position, (a, b) in enumerate(zip(words, candidate)) if position not in typos):
+                continue
+            edits = [edit_distance(words[position], candidate[position], typo_budget(words[position]))
+                     for position in typos]
+            if any(edit > typo_budget(words[position]) for edit, position in zip(edits, typos)):
+                continue
+            # Ties go to the alphabetically first name so the result does not depend on set order
+            if best_edits is None or (sum(edits), self.names[i]) < (best_edits, self.names[best]):
+                best, best_edits = i, sum(edits)
+        return None if best is None else self.exact[self.names[best]]
+
+    def _canonical(self, token):
+        """Canonical name for token; '' for tokens made only of qualifiers."""
+        key = self.normalize(token)
+        if not key:
+            return ""
+        return self.match(key) or key
+
+    def canonical_pair(self, head, qualifier):
+        """
+        Canonical name for a head and a bracketed single-word qualifier, like
+        'flour (wheat)', when 'wheat flour' is a known name; otherwise None.
+        """
+        if " " in qualifier:
+            return None
+        return self.match(self.normalize(f"{qualifier} {head}"), fuzzy=False)
+
+
+def field_canonicalizers():
+    """Canonicalizers by list field: the ingredients and the two allergen fields each use their own synonyms."""
+    allergens = Canonicalizer(ALLERGEN_SYNONYMS)
+    return {"ingredients": Canonicalizer(INGREDIENT_SYNONYMS), "allergen": allergens, "allergen_may_contain": allergens}
+
+
+def canonicalize_lists(vocab, lists, parents, canonicalizers):
+    """
+    Rewrites interned token lists to canonical names, using the
+    canonicalizer of each field in canonicalizers. Each distinct token of a
+    field is canonicalized once and the codes remapped; tokens made only of
+    qualifiers are dropped. In the ingredients, a token whose brackets hold
+    a single word, and which together with it names a known ingredient, as
+    in 'flour (wheat)', is merged with it into that ingredient. parents
+    links each ingredient token to the position of its parent in the codes,
+    or -1; a dropped token's children move up to its parent.
+    Returns (vocab, lists, parents).
+    """
+    new_ids = {}
+    canonical_lists = {}
+    for field, (offsets, codes) in lists.items():
+        canonicalizer = canonicalizers[field]
+        used = np.unique(codes)
+        remap = np.full(len(vocab), -1, dtype=np.int32)
+        remap[used] = [new_ids.setdefault(name, len(new_ids)) if name else -1
+                       for name in map(canonicalizer.canonical, vocab[used])]
+        codes = remap[codes]
+        rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+        if field == "ingredients":
+            nested = parents >= 0
+            only_child = nested.copy()
+            only_child[nested] = np.bincount(parents[nested], minlength=len(codes))[parents[nested]] == 1
+            children = np.flatnonzero(only_child & (codes >= 0))
+            heads = parents[children]
+            children, heads = children[codes[heads] >= 0], heads[codes[heads] >= 0]
+            # Each distinct (head, qualifier) pair is looked up once
+            names = list(new_ids)
+            keys, inverse = np.unique(codes[heads].astype(np.int64) * len(names) + codes[children],
+                                      return_inverse=True)
+            merged = np.array([-1 if name is None else new_ids.setdefault(name, len(new_ids))
+                               for name in (canonicalizer.canonical_pair(names[key // len(names)], names[key % len(names)])
+                                            for key in keys)], dtype=np.int32)[inverse]
+            children, heads, merged = children[merged >= 0], heads[merged >= 0], merged[merged >= 0]
+            # In 'flour (wheat (x))' where both pairs match, the outer one merges
+            outer = ~np.isin(heads, children)
+            codes[heads[outer]] = merged[outer]
+            codes[children[outer]] = -1
+
+        keep = codes >= 0
+        new_offsets = np.zeros(len(offsets), dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(offsets) - 1), out=new_offsets[1:])
+        canonical_lists[field] = (new_offsets, codes[keep])
+        if field == "ingredients":
+            dropped = (parents >= 0) & ~keep[parents]
+            while dropped.any():
+                parents = np.where(dropped, parents[parents], parents)
+                dropped = (parents >= 0) & ~keep[parents]
+            positions = np.cumsum(keep, dtype=np.int64) - 1
+            parents = np.where(parents >= 0, positions[parents], -1)[keep].astype(np.int32)
+
+    canonical_vocab = np.empty(len(new_ids), dtype=object)
+    canonical_vocab[:] = list(new_ids)
+    return canonical_vocab, canonical_lists, parents
+
+
+# ---------------- MATERIAL STORE ----------------
+def parse_nutrient_matrix(texts):
+    """
+    Parses nutrition strings into a float matrix with one row per string and
+    one column per nutrient name (NaN where not declared), plus a boolean
+    matrix marking values declared as upper bounds ('<0.5 g'). Returns
+    (matrix, upper_bounds, nutrient_names, nutrient_units).
+    """
+    nutrient_ids = {}
+    nutrient_units = []
+    cell_rows, cell_cols, cell_values, cell_bounds = array("q"), array("q"), array("d"), array("b")
+
+    for row_no, text in enumerate(texts):
+        for key, value in parse_nutrition_string(text).items():
+            parsed = parse_nutrient_value(value)
+            if parsed is None:
+                continue
+            val, unit = parsed
+            col = nutrient_ids.setdefault(key, len(nutrient_ids))
+            if col == len(nutrient_units):
+                nutrient_units.append(None)
+            nutrient_units[col] = unit or default_nutrient_unit(key)
+            cell_rows.append(row_no)
+            cell_cols.append(col)
+            cell_values.append(val)
+            cell_bounds.append(value.lstrip().startswith("<"))
+
+    cells = np.frombuffer(cell_rows, dtype=np.int64), np.frombuffer(cell_cols, dtype=np.int64)
+    matrix = np.full((len(texts), len(nutrient_ids)), np.nan)
+    matrix[cells] = np.frombuffer(cell_values, dtype=np.float64)
+    upper_bounds = np.zeros(matrix.shape, dtype=bool)
+    upper_bounds[cells] = np.frombuffer(cell_bounds, dtype=np.int8).astype(bool)
+    return matrix, upper_bounds, list(nutrient_ids), nutrient_units
+
+
+class MaterialStore:
+    """
+    Compact, column-oriented store for parsed material records.
+
+    Tokens from all list fields are interned into one shared vocabulary and
+    each list field is kept as CSR-style (offsets, codes) integer arrays;
+    ingredient tokens also keep the link to the token whose brackets they
+    were declared in. Material numbers are categorical and nutrients live in a float matrix
+    (NaN where a material does not declare a nutrient), with a flag for
+    values declared as upper bounds. The raw text is not kept; to_arrow()
+    renders the parsed tokens and values for the rows that are displayed.
+    """
+
+    def __init__(self, material_no, vocab, lists, parents, nutrients, upper_bounds, nutrient_names, nutrient_units):
+        self.material_no = material_no          # pd.Categorical, one entry per row
+        self.vocab = vocab                      # object array of distinct token strings
+        self.lists = lists                      # field -> (offsets int64[n + 1], codes int32)
+        self.parents = parents                  # int32 per ingredients code: position of its parent token, or -1
+        self.nutrients = nutrients              # float64[n, len(nutrient_names)]
+        self.upper_bounds = upper_bounds        # bool, same shape: declared as '<value'
+        self.nutrient_names = nutrient_names
+        self.nutrient_units = nutrient_units
+
+    @classmethod
+    def from_arrow(cls, table, canonicalizers=None):
+        """
+        Builds a store from a raw lookup table with RAW_COLUMNS. List fields
+        are tokenized by tokenize_column() and interned with one Arrow
+        dictionary; only nested declarations and the nutrition text are
+        parsed row by row. With canonicalizers by field (see
+        field_canonicalizers()), tokens are mapped to canonical names, see
+        canonicalize_lists().
+        """
+        columns = {name: table[name].combine_chunks().cast(pa.string()) for name in RAW_COLUMNS}
+        n = table.num_rows
+
+        field_offsets, field_tokens = {}, []
+        for field in LIST_FIELDS:
+            if field == "ingredients":
+                tokens, rows, parents = tokenize_column(columns[field], with_parents=True)
+            else:
+                tokens, rows = tokenize_column(columns[field])
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+            if field == "ingredients":
+                parents = np.where(parents >= 0, parents + offsets[rows], -1).astype(np.int32)
+            field_offsets[field] = offsets
+            field_tokens.append(tokens)
+
+        # One dictionary across all fields interns every distinct token once
+        encoded = pc.dictionary_encode(pa.concat_arrays(field_tokens))
+        codes = encoded.indices.to_numpy().astype(np.int32)
+        lists, start = {}, 0
+        for field, tokens in zip(LIST_FIELDS, field_tokens):
+            lists[field] = (field_offsets[field], codes[start:start + len(tokens)])
+            start += len(tokens)
+
+        vocab = encoded.dictionary.to_numpy(zero_copy_only=False)
+        if canonicalizers is not None:
+            vocab, lists, parents = canonicalize_lists(vocab, lists, parents, canonicalizers)
+
+        material_no = pc.dictionary_encode(columns["material_no"])
+        nutrients, upper_bounds, nutrient_names, nutrient_units = parse_nutrient_matrix(
+            columns["nutritional_information"].to_pylist())
+        return cls(
+            pd.Categorical.from_codes(material_no.indices.to_numpy(), material_no.dictionary.to_pylist()),
+            vocab, lists, parents, nutrients, upper_bounds, nutrient_names, nutrient_units,
+        )
+
+    @classmethod
+    def from_records(cls, rows):
+        """Builds a store from an iterable of raw lookup tuples."""
+        rows = iter(rows)
+        return cls.from_arrow(records_to_arrow(iter(lambda: list(itertools.islice(rows, FETCH_BATCH_SIZE)), [])))
+
+    def __len__(self):
+        return len(self.material_no)
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the store, including the token strings."""
+        categories = self.material_no.categories
+        total = self.material_no.codes.nbytes + categories.memory_usage(deep=True)
+        total += self.vocab.nbytes + sum(sys.getsizeof(token) for token in self.vocab)
+        total += sum(offsets.nbytes + codes.nbytes for offsets, codes in self.lists.values()) + self.parents.nbytes
+        return int(total + self.nutrients.nbytes + self.upper_bounds.nbytes)
+
+    @functools.cached_property
+    def vocab_arrow(self):
+        return pa.array(self.vocab, pa.string())
+
+    @functools.cached_property
+    def categories_arrow(self):
+        return pa.array(self.material_no.categories.to_numpy(), pa.string())
+
+    def material_arrow(self, rows):
+        return self.categories_arrow.take(self.material_no.codes[rows])
+
+    def rows_of(self, material_nos):
+        """Boolean row mask selecting the given material numbers."""
+        return self.material_no.categories.isin(list(material_nos))[self.material_no.codes]
+
+    def unique_tokens(self, field, rows=None):
+        """Sorted distinct tokens of field, optionally only for rows in a boolean mask."""
+        offsets, codes = self.lists[field]
+        if rows is not None:
+            codes = codes[np.repeat(rows, np.diff(offsets))]
+        return sorted(self.vocab[np.unique(codes)])
+
+    def weight_vector(self, weights=None, default=100):
+        """Per-row weights in grams, using default for materials without one."""
+        if not weights:
+            return np.full(len(self), float(default))
+        per_material = np.array([float(weights.get(m, default)) for m in self.material_no.categories])
+        return per_material[self.material_no.codes]
+
+    def nutrient_totals(self, weights=None, default=100):
+        """Weighted nutrient totals as a float array aligned with nutrient_names."""
+        scale = self.weight_vector(weights, default) / 100.0
+        # A nutrient column only exists if some row declares it, so zero-filling is safe
+        return scale @ np.nan_to_num(self.nutrients)
+
+    def nutrition_totals(self, weights=None, default=100):
+        """Weighted nutrient totals formatted for display, one entry per declared nutrient."""
+        return format_nutrition(
+            dict(zip(self.nutrient_names, self.nutrient_totals(weights, default))),
+            dict(zip(self.nutrient_names, self.nutrient_units)),
+        )
+
+    def token_lists(self, field, rows):
+        """Arrow list array with the tokens of field for the given row positions."""
+        offsets, codes = self.lists[field]
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        sub_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=sub_offsets[1:])
+        positions = np.repeat(starts - sub_offsets[:-1], lengths) + np.arange(sub_offsets[-1])
+        return pa.LargeListArray.from_arrays(sub_offsets, self.vocab_arrow.take(codes[positions]))
+
+    def to_arrow(self, rows=None):
+        """
+        Renders the parsed records for the given row positions (all rows by
+        default) as an Arrow table with RAW_COLUMNS, using vectorised gathers
+        and string joins. Lists show the parsed (and canonical) tokens, not
+        the label text; upper-bound nutrient values keep their '<'.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        columns = [self.material_arrow(rows)]
+        for field in LIST_FIELDS:
+            columns.append(pc.binary_join(self.token_lists(field, rows), ", "))
+
+        # Each declared nutrient renders as ", Name: value unit" (null when NaN);
+        # the parts are concatenated and the leading separator sliced off.
+        parts = [
+            pc.binary_join_element_wise(
+                pa.array(np.where(self.upper_bounds[rows, col], f", {name}: <", f", {name}: ")),
+                pc.cast(pa.array(self.nutrients[rows, col], from_pandas=True), pa.string()),
+                f" {self.nutrient_units[col]}", "")
+            for col, name in enumerate(self.nutrient_names)
+        ]
+        nutrition = pc.binary_join_element_wise(*parts, "", null_handling="replace", null_replacement="") \
+            if parts else pa.array([""] * len(rows), pa.string())
+        columns.append(pc.utf8_slice_codeunits(nutrition, 2))
+        return pa.Table.from_arrays(columns, names=RAW_COLUMNS)
+
+
+# ---------------- UPLOADS ----------------
+RECIPE_EXTENSIONS = (".csv", ".xlsx")
+
+
+def unique_name(name, taken):
+    """name, or 'stem (2).ext', 'stem (3).ext', ... if it is already in taken."""
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in taken:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    taken.add(candidate)
+    return candidate
+
+
+def expand_uploads(uploaded_files):
+    """
+    Returns [(name, bytes)] for every recipe file, unpacking zip archives.
+    Recipes are keyed by name from here on, so repeated names are numbered.
+    """
+    files = []
+    for uploaded in uploaded_files:
+        if not uploaded.name.lower().endswith(".zip"):
+            files.append((uploaded.name, uploaded.getvalue()))
+            continue
+        with zipfile.ZipFile(io.BytesIO(uploaded.getvalue())) as archive:
+            for info in archive.infolist():
+                base = os.path.basename(info.filename)
+                # Skip folders and the resource-fork entries macOS adds to archives
+                if info.is_dir() or base.startswith("._") or info.filename.startswith("__MACOSX/"):
+                    continue
+                if base.lower().endswith(RECIPE_EXTENSIONS):
+                    files.append((f"{uploaded.name}/{info.filename}", archive.read(info)))
+    taken = set()
+    return [(unique_name(name, taken), data) for name, data in files]
+
+
+DEFAULT_WEIGHT = 100.0
+ISSUE_COLUMNS = ["row", "material_no", "weight", "severity", "issue"]
+
+
+def validate_recipe(df_input):
+    """
+    Normalizes a raw recipe table with column operations: IDs are stripped
+    and Excel float artefacts like '1234.0' undone, weights coerced to
+    numbers, blank rows dropped and duplicate materials summed. Returns
+    (recipe, issues): one row per material_no with its total weight, and
+    one row per problem or correction found in an input row.
+    """
+    raw_ids = df_input["material_no"].astype("string")
+    ids = raw_ids.str.strip().str.replace(r"^(\d+)\.0+$", r"\1", regex=True)
+    ids = ids.mask(ids == "")
+    if "weight" in df_input.columns:
+        raw_weights = df_input["weight"].astype("string").str.strip()
+        raw_weights = raw_weights.mask(raw_weights == "")
+    else:
+        raw_weights = pd.Series(pd.NA, index=df_input.index, dtype="string")
+    weights = pd.to_numeric(raw_weights, errors="coerce").astype(float)
+
+    blank = ids.isna() & raw_weights.isna()
+    checks = [
+        (ids.isna() & ~blank, "error", "missing material_no"),
+        (ids.notna() & raw_weights.notna() & weights.isna(), "error", "weight is not a number"),
+        # 'inf' and values like '1e400' parse as infinite
+        (ids.notna() & np.isinf(weights), "error", "weight is not a finite number"),
+        (ids.notna() & np.isfinite(weights) & (weights < 0), "error", "negative weight"),
+    ]
+    rejected = np.logical_or.reduce([mask.to_numpy(dtype=bool) for mask, _, _ in checks])
+    valid = ~blank.to_numpy(dtype=bool) & ~rejected
+    checks.append((valid & (ids != raw_ids).fillna(False).to_numpy(dtype=bool), "warning",
+                   "material_no normalized (spaces or trailing '.0' removed)"))
+    if "weight" in df_input.columns:
+        checks.append((valid & raw_weights.isna(), "warning", f"no weight, {DEFAULT_WEIGHT:g} g assumed"))
+    checks.append((valid & ids.where(valid).duplicated(keep=False), "warning", "duplicate material, weights summed"))
+
+    recipe = (pd.DataFrame({"material_no": ids[valid], "weight": weights[valid].fillna(DEFAULT_WEIGHT)})
+              .groupby("material_no", sort=False, as_index=False)["weight"].sum())
+    # Row numbers as shown in a spreadsheet: the header is row 1
+    issues = pd.concat([
+        pd.DataFrame({
+            "row": df_input.index[mask] + 2, "material_no": df_input["material_no"][mask],
+            "weight": raw_weights[mask], "severity": severity, "issue": issue,
+        }, columns=ISSUE_COLUMNS)
+        for mask, severity, issue in checks
+    ]).sort_values("row", kind="stable", ignore_index=True)
+    return recipe, issues
+
+
+def read_recipe_file(name, data):
+    """
+    Reads one recipe file into {'material_nos', 'weights', 'rows', 'issues'},
+    or {'error', 'issues'} when it cannot be used.
+    """
+    # Read as text so IDs keep their spelling and skipped lines keep their row numbers
+    if name.lower().endswith(".csv"):
+        df_input = pd.read_csv(io.BytesIO(data), dtype=str, skip_blank_lines=False)
+    else:
+        df_input = pd.read_excel(io.BytesIO(data), dtype=str)
+    df_input = df_input.rename(columns=lambda column: str(column).strip())
+
+    if "material_no" not in df_input.columns:
+        return {"error": "The file must contain a 'material_no' column.",
+                "issues": pd.DataFrame(columns=ISSUE_COLUMNS)}
+    recipe, issues = validate_recipe(df_input)
+    if recipe.empty:
+        return {"error": "No row has a usable material_no and weight.", "issues": issues}
+    return {
+        "material_nos": recipe["material_no"].tolist(),
+        "weights": dict(zip(recipe["material_no"], recipe["weight"])),
+        "rows": len(df_input),
+        "issues": issues,
+    }
+
+
+def validation_report(recipes):
+    """Every file's validation issues in one frame, with the file name first."""
+    reports = [recipe["issues"].assign(file=name) for name, recipe in recipes.items()
+               if not recipe.get("issues", pd.DataFrame()).empty]
+    if not reports:
+        return pd.DataFrame(columns=["file"] + ISSUE_COLUMNS)
+    return pd.concat(reports, ignore_index=True)[["file"] + ISSUE_COLUMNS]
+
+
+def merge_weights(recipes):
+    """Sums each material's weight across all recipes."""
+    weights = {}
+    for recipe in recipes.values():
+        for material_no, weight in recipe["weights"].items():
+            weights[material_no] = weights.get(material_no, 0) + weight
+    return weights
+
+
+def recipe_summary(store, recipes):
+    """One row per recipe file with its allergens and nutrition totals."""
+    found = set(store.material_no.categories)
+    summary = []
+    for name, recipe in recipes.items():
+        rows = store.rows_of(recipe["weights"])
+        totals = store.nutrient_totals(recipe["weights"], default=0)
+        row = {
+            "file": name,
+            "materials": len(recipe["weights"]),
+            "not found": len(set(recipe["weights"]) - found),
+            "allergens": ", ".join(store.unique_tokens("allergen", rows)),
+            "may contain": ", ".join(store.unique_tokens("allergen_may_contain", rows)),
+        }
+        for col, name in enumerate(store.nutrient_names):
+            row[f"{name} ({store.nutrient_units[col]})"] = round(totals[col], 2)
+        summary.append(row)
+    return pd.DataFrame(summary)
+
+
+# ---------------- BILL OF MATERIALS ----------------
+def code_bitsets(store, field):
+    """
+    Per material category, the token codes of field across its rows as a
+    bitset: a Python int over the field's own distinct codes, so a union is
+    one '|' however many tokens it holds. Returns (codes, bitsets), where
+    bit i stands for codes[i].
+    """
+    offsets, codes = store.lists[field]
+    owners = np.repeat(store.material_no.codes, np.diff(offsets))
+    field_codes, bits = np.unique(codes, return_inverse=True)
+    bitsets = [0] * len(store.material_no.categories)
+    for owner, bit in zip(owners.tolist(), bits.tolist()):
+        bitsets[owner] |= 1 << bit
+    return field_codes, bitsets
+
+
+def bitset_positions(bitset):
+    """Positions of the set bits, ascending."""
+    packed = np.frombuffer(bitset.to_bytes((bitset.bit_length() + 7) // 8, "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, bitorder="little"))
+
+
+def expand_bom(nodes, found, edges, material_nos):
+    """
+    Rolls sub-assemblies up into their parents and returns (store, cycles,
+    unquantified): a MaterialStore with one row per material in material_nos
+    that exists either in allergen_info or as a BOM parent, the cycles that
+    were broken, and the "parent → child" edges without a quantity.
+    Allergens, may-contain and ingredients are the union over the subtree;
+    a nutrient the material does not declare itself is the sum of its
+    children's values scaled by quantity / 100. A child without a quantity
+    still adds its tokens but is left out of the sums. Each node is resolved
+    once, after its children, so shared intermediates are computed once
+    for all recipes. Token unions are bitsets, and an intermediate's bitset
+    is dropped once all its parents are resolved, so a deep BOM with
+    distinct tokens per node does not keep every subtree's tokens.
+    """
+    materials = pd.Index(nodes.material_no.categories)
+    n, width = len(materials), len(nodes.nutrient_names)
+    field_codes, rolled = {}, {}
+    for field in LIST_FIELDS:
+        field_codes[field], rolled[field] = code_bitsets(nodes, field)
+
+    # A material's own nutrients, summed over its rows like NutritionTotals does
+    values = np.zeros((n, width))
+    declared = np.zeros((n, width), dtype=bool)
+    bounded = np.zeros((n, width), dtype=bool)
+    np.add.at(values, nodes.material_no.codes, np.nan_to_num(nodes.nutrients))
+    np.logical_or.at(declared, nodes.material_no.codes, ~np.isnan(nodes.nutrients))
+    np.logical_or.at(bounded, nodes.material_no.codes, nodes.upper_bounds)
+
+    # Edges as CSR arrays ordered by parent; edges that close a cycle are switched off
+    parents = [parent for parent, (kids, _) in edges.items() for _ in kids]
+    kids = materials.get_indexer([kid for kids, _ in edges.values() for kid in kids])
+    quantities = np.array([q for _, qs in edges.values() for q in qs], dtype=float) / 100.0
+    unquantified = [f"{parent} → {kid}" for parent, (children, qs) in edges.items()
+                    for kid, q in zip(children, qs) if q is None]
+    parents = materials.get_indexer(parents)
+    order = np.argsort(parents, kind="stable")
+    kids, quantities = kids[order], quantities[order]
+    edge_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parents, minlength=n), out=edge_offsets[1:])
+    active = kids >= 0
+
+    # Iterative depth-first walk over plain lists; state 1 marks nodes on the current path
+    bounds, targets, live = edge_offsets.tolist(), kids.tolist(), active.tolist()
+    state = [0] * n
+    post_order, cycles = [], []
+    for root in range(n):
+        if state[root]:
+            continue
+        stack = [[root, bounds[root]]]
+        state[root] = 1
+        while stack:
+            top = stack[-1]
+            node, edge = top
+            if edge < bounds[node + 1]:
+                top[1] += 1
+                child = targets[edge]
+                if not live[edge] or state[child] == 2:
+                    continue
+                if state[child] == 1:
+                    on_path = [entry[0] for entry in stack]
+                    cycle = on_path[on_path.index(child):] + [child]
+                    cycles.append(" → ".join(materials[cycle]))
+                    live[edge] = False
+                else:
+                    state[child] = 1
+                    stack.append([child, bounds[child]])
+                continue
+            stack.pop()
+            state[node] = 2
+            post_order.append(node)
+
+    # Children always come before their parents in post-order
+    active = np.array(live, dtype=bool)
+    kids, quantities = kids[active], quantities[active]
+    np.cumsum(np.bincount(parents[order][active], minlength=n), out=edge_offsets[1:])
+    bounds = edge_offsets.tolist()
+    wanted = [m for m in dict.fromkeys(material_nos) if m in found or m in edges]
+    rows = materials.get_indexer(wanted)
+    pending = np.bincount(kids, minlength=n).tolist()
+    keep = np.zeros(n, dtype=bool)
+    keep[rows] = True
+    keep = keep.tolist()
+    for node in post_order:
+        start, end = bounds[node], bounds[node + 1]
+        if start == end:
+            continue
+        node_kids = kids[start:end]
+        for field in LIST_FIELDS:
+            bitsets = rolled[field]
+            union = bitsets[node]
+            for kid in node_kids.tolist():
+                union |= bitsets[kid]
+            bitsets[node] = union
+        for kid in node_kids.tolist():
+            pending[kid] -= 1
+            if not pending[kid] and not keep[kid]:
+                for field in LIST_FIELDS:
+                    rolled[field][kid] = 0
+        weighed = ~np.isnan(quantities[start:end])
+        weighed_kids = node_kids[weighed]
+        own = declared[node]
+        values[node] = np.where(own, values[node], quantities[start:end][weighed] @ values[weighed_kids])
+        # A sum that includes an upper bound is itself only an upper bound
+        bounded[node] = np.where(own, bounded[node], bounded[weighed_kids].any(axis=0))
+        declared[node] = own | declared[weighed_kids].any(axis=0)
+
+    lists = {}
+    for field in LIST_FIELDS:
+        parts = [field_codes[field][bitset_positions(rolled[field][row])] for row in rows.tolist()]
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(part) for part in parts], out=offsets[1:])
+        lists[field] = (offsets, np.concatenate(parts).astype(np.int32) if parts else np.zeros(0, dtype=np.int32))
+    # A roll-up is the union of the subtree's tokens, so it has no nesting
+    parents = np.full(len(lists["ingredients"][1]), -1, dtype=np.int32)
+    store = MaterialStore(
+        pd.Categorical(wanted, categories=wanted), nodes.vocab, lists, parents,
+        np.where(declared[rows], values[rows], np.nan), bounded[rows], nodes.nutrient_names, nodes.nutrient_units,
+    )
+    return store, cycles, unquantified
+
+
+# ---------------- ADMISSION CONTROL ----------------
+ADMISSION_POLL_SECONDS = 0.25
+
+
+class LookupSuperseded(Exception):
+    """The lookup was cancelled because a newer one started in the same session."""
+
+
+class AdmissionController:
+    """
+    Bounds the number of database lookups running at once across all
+    sessions. Lookups beyond the limit wait in a FIFO queue; a slot is held
+    from admission until release(), which the worker calls when the query
+    has actually finished.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.active = 0
+        self.queue = deque()
+        self.cond = threading.Condition()
+
+    def acquire(self, on_wait=None):
+        """
+        Blocks until a slot is free and this caller is first in line.
+        on_wait(position) runs between polls, outside the lock; if it raises
+        (e.g. Streamlit interrupting the script for a rerun) the caller leaves
+        the queue.
+        """
+        ticket = object()
+        with self.cond:
+            self.queue.append(ticket)
+        try:
+            while True:
+                with self.cond:
+                    if self.queue[0] is ticket and self.active < self.slots:
+                        self.queue.popleft()
+                        self.active += 1
+                        self.cond.notify_all()
+                        return
+                    position = self.queue.index(ticket) + 1
+                if on_wait is not None:
+                    on_wait(position)
+                with self.cond:
+                    self.cond.wait_for(lambda: self.queue[0] is ticket and self.active < self.slots,
+                                       timeout=ADMISSION_POLL_SECONDS)
+        except BaseException:
+            with self.cond:
+                self.queue.remove(ticket)
+                self.cond.notify_all()
+            raise
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+
+class LookupGenerations:
+    """
+    One session's lookups, numbered in the order they start. Starting a
+    lookup cancels the older ones still in flight: one that has not
+    connected yet stops as soon as it does, a running query is cancelled
+    server-side through its connection. Connections are registered,
+    unregistered and cancelled under one lock, so a connection is never
+    cancelled while or after its lookup closes it.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.inflight = {}      # generation -> open connection, or None while not connected
+        self.cancelled = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Numbers a new lookup and cancels all older ones. Returns its generation."""
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.cancel_before(generation)
+        return generation
+
+    def track(self, generation):
+        """Marks the lookup as in flight, so newer lookups cancel it."""
+        with self.lock:
+            self.inflight[generation] = None
+
+    def connected(self, generation, conn):
+        """
+        Registers the lookup's connection, or with None unregisters it before
+        it is closed. Raises LookupSuperseded if the lookup was cancelled
+        before it connected.
+        """
+        with self.lock:
+            if generation in self.inflight:
+                self.inflight[generation] = conn
+            if conn is not None and generation in self.cancelled:
+                raise LookupSuperseded("a newer lookup replaced this one")
+
+    def finish(self, generation):
+        with self.lock:
+            self.inflight.pop(generation, None)
+            self.cancelled.discard(generation)
+
+    def cancel_before(self, before):
+        """Cancels every lookup in flight older than generation before."""
+        with self.lock:
+            for generation, conn in self.inflight.items():
+                if generation < before:
+                    self.cancelled.add(generation)
+                    # A connection the server dropped cannot be cancelled and has nothing running
+                    if conn is not None and not conn.closed:
+                        conn.cancel()
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+
+# ---------------- DATA VIEW ----------------
+SEARCH_SCOPES = {
+    "All": ["material_no", "allergen", "ingredients"],
+    "Material No": ["material_no"],
+    "Allergens": ["allergen"],
+    "Ingredients": ["ingredients"],
+}
+SORT_COLUMNS = {"Material No": "material_no", "Allergens": "allergen", "Ingredients": "ingredients"}
+PAGE_SIZES = [25, 50, 100, 250]
+
+
+class TableIndex:
+    """
+    Server-side search and sort index over a MaterialStore, so the data view
+    only ever sends one page of rows to the browser.
+
+    Sort orders are computed once per column on first use. Text searches run
+    against the token vocabulary and map hits back to rows through the codes,
+    so the cost scales with the number of distinct tokens rather than text size.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._orders = {}
+
+    def order(self, column):
+        """Row positions sorted ascending by column."""
+        if column not in self._orders:
+            store = self.store
+            if column == "material_no":
+                # Numeric material numbers sort numerically, anything else after them as text
+                categories = pd.Series(store.material_no.categories.to_numpy(), dtype=object).astype(str)
+                numeric = pd.to_numeric(categories, errors="coerce").fillna(np.inf).to_numpy()
+                ranks = np.empty(len(categories), dtype=np.int64)
+                ranks[np.lexsort((categories.to_numpy(), numeric))] = np.arange(len(categories))
+                order = np.argsort(ranks[store.material_no.codes], kind="stable")
+            else:
+                # Only this column's text is built, not the whole display table
+                joined = pc.binary_join(store.token_lists(column, np.arange(len(store))), ", ")
+                order = pc.sort_indices(joined).to_numpy()
+            self._orders[column] = order
+        return self._orders[column]
+
+    def matching_rows(self, query, columns):
+        """Boolean mask of rows whose columns contain query (case-insensitive)."""
+        store = self.store
+        query = query.strip().lower()
+        if not query:
+            return np.ones(len(store), dtype=bool)
+
+        mask = np.zeros(len(store), dtype=bool)
+        for column in columns:
+            if column == "material_no":
+                hits = pc.match_substring(store.categories_arrow, query, ignore_case=True).to_numpy(zero_copy_only=False)
+                mask |= hits[store.material_no.codes]
+            else:
+                offsets, codes = store.lists[column]
+                vocab_hits = pc.match_substring(store.vocab_arrow, query).to_numpy(zero_copy_only=False)
+                positions = np.flatnonzero(vocab_hits[codes])
+                mask[np.searchsorted(offsets, positions, side="right") - 1] = True
+        return mask
+
+    def page(self, mask, sort_column, descending, page, page_size):
+        """Arrow table with one page of the rows selected by mask, in sort order."""
+        order = self.order(sort_column)
+        if descending:
+            order = order[::-1]
+        start = (page - 1) * page_size
+        return self.store.to_arrow(order[mask[order]][start:start + page_size])
+
+
+# ---------------- WEIGHT EDITING ----------------
+class NutritionTotals:
+    """
+    Weighted nutrient totals that follow weight edits incrementally.
+
+    Nutrients are summed per material once (per gram, across duplicate rows);
+    after that a weight change only adds delta * per-material nutrients to
+    the totals, without touching the store or the database.
+    """
+
+    def __init__(self, store, weights):
+        self.store = store
+        self.materials = pd.Index(store.material_no.categories)
+        self.per_gram = np.zeros((len(self.materials), len(store.nutrient_names)))
+        np.add.at(self.per_gram, store.material_no.codes, np.nan_to_num(store.nutrients) / 100.0)
+        self.weights = np.array([float(weights.get(m, DEFAULT_WEIGHT)) for m in self.materials])
+        self.totals = self.weights @ self.per_gram
+
+    def update(self, material_nos, new_weights):
+        """
+        Applies new weights for material_nos; materials not in the lookup and
+        missing weights are ignored rather than counted as 0 g.
+        """
+        positions = self.materials.get_indexer(list(material_nos))
+        new_weights = np.asarray(new_weights, dtype=float)
+        found = (positions >= 0) & np.isfinite(new_weights)
+        positions, new_weights = positions[found], new_weights[found]
+        delta = new_weights - self.weights[positions]
+        changed = delta != 0
+        self.totals += delta[changed] @ self.per_gram[positions[changed]]
+        self.weights[positions] = new_weights
+
+    def weight_map(self):
+        return dict(zip(self.materials, self.weights))
+
+    def formatted(self):
+        return format_nutrition(dict(zip(self.store.nutrient_names, self.totals)),
+                                dict(zip(self.store.nutrient_names, self.store.nutrient_units)))
+
+
+# ---------------- OPTIMIZER ----------------
+def materials_with_allergens(store, allergens):
+    """Boolean mask over store.material_no.categories: materials that contain or may contain any of allergens."""
+    flagged = np.zeros(len(store.material_no.categories), dtype=bool)
+    claim = np.isin(store.vocab, list(allergens))
+    for field in ("allergen", "allergen_may_contain"):
+        offsets, codes = store.lists[field]
+        hits = np.flatnonzero(claim[codes])
+        rows = np.searchsorted(offsets, hits, side="right") - 1
+        flagged[store.material_no.codes[rows]] = True
+    return flagged
+
+
+def optimize_weights(totals, total_mass, targets, excluded=None):
+    """
+    Proposes weights (g) for every material in totals that sum to total_mass,
+    keep each nutrient total within targets {nutrient: (min, max)} (either
+    bound may be None) and stay as close as possible, in summed absolute
+    change, to the current weights. Materials flagged in excluded are fixed
+    at 0. Solved as one linear program over the material x nutrient matrix
+    that NutritionTotals already holds, with one row per nutrient bound, so
+    its size grows linearly with the number of materials.
+    Returns (weights or None, message).
+    """
+    n = len(totals.materials)
+    per_gram = totals.per_gram
+    current = totals.weights
+    # Variables are [up, down] with w = current + up - down; the objective is
+    # sum(up + down), which equals sum(|w - current|) at the optimum
+    cost = np.ones(2 * n)
+    upper = np.full(n, float(total_mass))
+    if excluded is not None:
+        upper[excluded] = 0.0
+    bounds = np.column_stack([
+        np.concatenate([np.zeros(n), np.maximum(current - upper, 0.0)]),
+        np.concatenate([np.maximum(upper - current, 0.0), current]),
+    ])
+    rows, limits = [], []
+    for col, name in enumerate(totals.store.nutrient_names):
+        low, high = targets.get(name, (None, None))
+        change = np.concatenate([per_gram[:, col], -per_gram[:, col]])
+        if high is not None:
+            rows.append(change)
+            limits.append(high - totals.totals[col])
+        if low is not None:
+            rows.append(-change)
+            limits.append(totals.totals[col] - low)
+    result = linprog(
+        cost,
+        A_ub=np.array(rows) if rows else None, b_ub=np.array(limits) if rows else None,
+        A_eq=np.concatenate([np.ones(n), -np.ones(n)])[None, :], b_eq=[total_mass - current.sum()],
+        bounds=bounds,
+        method="highs",
+    )
+    if result.status != 0:
+        return None, result.message
+    weights = current + result.x[:n] - result.x[n:]
+    return weights, f"Changed {np.count_nonzero(np.abs(weights - current) > 1e-6)} of {n} weights"
+
+
+# ---------------- EXPORT ----------------
+EXPORT_DATASETS = ["Parsed lookup", "Parsed fields", "Allergen matrix", "Nutrition totals"]
+EXPORT_FORMATS = {
+    "CSV": (".csv", "text/csv"),
+    "Excel": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "Parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+EXPORT_CHUNK_ROWS = 50_000
+EXCEL_SHEET_ROWS = 1_048_575  # Excel's row limit minus the header row
+
+
+def export_batches(store, dataset, weights=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Yields the requested dataset as Arrow RecordBatches of at most chunk_rows
+    rows, built straight from the store so no full-size frame is ever created.
+    'Parsed lookup' is the text view of MaterialStore.to_arrow(), not the
+    label text as stored in allergen_info.
+    """
+    if dataset == "Nutrition totals":
+        yield pa.RecordBatch.from_pydict({
+            "nutrient": store.nutrient_names,
+            "value": pa.array(np.round(store.nutrient_totals(weights), 2)),
+            "unit": store.nutrient_units,
+        })
+        return
+
+    if dataset == "Allergen matrix":
+        # One column per allergen seen anywhere in the lookup, fixed up front so every chunk shares a schema
+        allergen_codes = np.union1d(store.lists["allergen"][1], store.lists["allergen_may_contain"][1])
+        allergen_codes = allergen_codes[np.argsort(store.vocab[allergen_codes])]
+        column_of = np.full(len(store.vocab), -1, dtype=np.int64)
+        column_of[allergen_codes] = np.arange(len(allergen_codes))
+        labels = np.array([None, "may contain", "contains"], dtype=object)
+
+    for start in range(0, max(len(store), 1), chunk_rows):
+        rows = np.arange(start, min(start + chunk_rows, len(store)))
+        if dataset == "Parsed lookup":
+            table = store.to_arrow(rows)
+            yield pa.record_batch([column.combine_chunks() for column in table.columns], names=table.column_names)
+        elif dataset == "Parsed fields":
+            columns = {"material_no": store.material_arrow(rows)}
+            for field in LIST_FIELDS:
+                columns[field] = store.token_lists(field, rows)
+            for col, name in enumerate(store.nutrient_names):
+                columns[f"{name} ({store.nutrient_units[col]}/100g)"] = pa.array(store.nutrients[rows, col], from_pandas=True)
+            yield pa.RecordBatch.from_pydict(columns)
+        elif dataset == "Allergen matrix":
+            matrix = np.zeros((len(rows), len(allergen_codes)), dtype=np.int8)
+            for field, level in (("allergen_may_contain", 1), ("allergen", 2)):
+                offsets, codes = store.lists[field]
+                lo, hi = offsets[rows[0]] if len(rows) else 0, offsets[rows[-1] + 1] if len(rows) else 0
+                row_of = np.searchsorted(offsets, np.arange(lo, hi), side="right") - 1 - start
+                matrix[row_of, column_of[codes[lo:hi]]] = level
+            columns = {"material_no": store.material_arrow(rows)}
+            for col, code in enumerate(allergen_codes):
+                columns[store.vocab[code]] = pa.array(labels[matrix[:, col]], pa.string())
+            yield pa.RecordBatch.from_pydict(columns)
+
+
+def flatten_lists(batch):
+    """Joins list columns into ', '-separated text for formats without nested types."""
+    columns = [
+        pc.binary_join(column, ", ") if pa.types.is_list(column.type) or pa.types.is_large_list(column.type)
+        else column
+        for column in batch.columns
+    ]
+    return pa.record_batch(columns, names=batch.schema.names)
+
+
+def write_export(batches, fmt, path):
+    """Streams batches into path one chunk at a time. Returns the number of rows written."""
+    batches = iter(batches)
+    first = next(batches)
+    written = 0
+
+    if fmt == "CSV":
+        batches = map(flatten_lists, itertools.chain([first], batches))
+        first = next(batches)
+        with pa_csv.CSVWriter(path, first.schema) as writer:
+            for batch in itertools.chain([first], batches):
+                writer.write_batch(batch)
+                written += batch.num_rows
+    elif fmt == "Parquet":
+        # Each chunk becomes its own row group
+        with pq.ParquetWriter(path, first.schema) as writer:
+            for batch in itertools.chain([first], batches):
+                writer.write_batch(batch, row_group_size=batch.num_rows or None)
+                written += batch.num_rows
+    else:
+        # Write-only workbooks stream rows to disk instead of building the sheet in memory
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet, sheet_rows = None, EXCEL_SHEET_ROWS
+        for batch in map(flatten_lists, itertools.chain([first], batches)):
+            for values in zip(*(column.to_pylist() for column in batch.columns)):
+                if sheet_rows == EXCEL_SHEET_ROWS:
+                    sheet = workbook.create_sheet(f"Sheet{len(workbook.worksheets) + 1}")
+                    sheet.append(first.schema.names)
+                    sheet_rows = 0
+                sheet.append(values)
+                sheet_rows += 1
+                written += 1
+        if sheet is None:
+            workbook.create_sheet("Sheet1").append(first.schema.names)
+        workbook.save(path)
+    return written
@@ -0,0 +1,165 @@
+import threading
+import time
+
+import pytest
+
+from materials import AdmissionController, LookupGenerations, LookupSuperseded
+
+
+class Interrupted(BaseException):
+    """Stands in for the exception Streamlit raises to stop a script."""
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_active_lookups_stay_within_slots():
+    controller = AdmissionController(2)
+    lock = threading.Lock()
+    running, peak = 0, 0
+
+    def lookup():
+        nonlocal running, peak
+        controller.acquire()
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+        controller.release()
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == 2
+    assert controller.active == 0 and not controller.queue
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    controller = AdmissionController(1)
+    controller.acquire()
+    admitted, threads = [], []
+
+    def lookup(i):
+        controller.acquire()
+        admitted.append(i)
+        controller.release()
+
+    for i in range(5):
+        threads.append(threading.Thread(target=lookup, args=(i,)))
+        threads[-1].start()
+        wait_until(lambda: len(controller.queue) == i + 1)
+    controller.release()
+    for thread in threads:
+        thread.join()
+    assert admitted == [0, 1, 2, 3, 4]
+
+
+def test_interrupted_waiter_leaves_the_queue():
+    controller = AdmissionController(1)
+    controller.acquire()
+    positions = []
+
+    def on_wait(position):
+        positions.append(position)
+        raise Interrupted
+
+    with pytest.raises(Interrupted):
+        controller.acquire(on_wait)
+    assert positions == [1]
+    assert not controller.queue
+
+    controller.release()
+    controller.acquire()
+    assert controller.active == 1
+
+
+class Connection:
+    """Stands in for a psycopg2 connection, which refuses cancel() once closed."""
+
+    def __init__(self):
+        self.closed = 0
+        self.cancels = 0
+
+    def cancel(self):
+        if self.closed:
+            raise RuntimeError("connection already closed")
+        self.cancels += 1
+
+    def close(self):
+        self.closed = 1
+
+
+def fetch(lookups, generation, conn):
+    """The connect/close sequence of fetch_material_info()."""
+    try:
+        lookups.connected(generation, conn)
+    finally:
+        lookups.connected(generation, None)
+        conn.close()
+
+
+def test_newer_lookup_cancels_running_query():
+    lookups = LookupGenerations()
+    first = lookups.start()
+    lookups.track(first)
+    conn = Connection()
+    lookups.connected(first, conn)
+    second = lookups.start()
+    assert conn.cancels == 1
+    assert not lookups.is_current(first) and lookups.is_current(second)
+
+
+def test_lookup_cancelled_before_connecting_stops():
+    lookups = LookupGenerations()
+    first = lookups.start()
+    lookups.track(first)
+    lookups.start()
+    conn = Connection()
+    with pytest.raises(LookupSuperseded):
+        fetch(lookups, first, conn)
+    assert conn.closed and conn.cancels == 0
+    lookups.finish(first)
+    assert not lookups.inflight and not lookups.cancelled
+
+
+def test_closed_connection_is_not_cancelled():
+    lookups = LookupGenerations()
+    first = lookups.start()
+    lookups.track(first)
+    conn = Connection()
+    fetch(lookups, first, conn)
+    # A rerun between close() and finish() must not touch the closed connection
+    lookups.start()
+    assert conn.cancels == 0
+
+
+def test_cancel_races_with_close():
+    lookups = LookupGenerations()
+    done = threading.Event()
+
+    def fetches():
+        while not done.is_set():
+            generation = lookups.start()
+            lookups.track(generation)
+            try:
+                fetch(lookups, generation, Connection())
+            except LookupSuperseded:
+                pass
+            lookups.finish(generation)
+
+    worker = threading.Thread(target=fetches)
+    worker.start()
+    try:
+        for _ in range(20_000):
+            lookups.cancel_before(lookups.generation + 1)
+    finally:
+        done.set()
+        worker.join()
@@ -0,0 +1,119 @@
+import random
+
+import numpy as np
+import pytest
+
+from materials import MaterialStore, expand_bom
+
+
+def expand(rows, edges, material_nos):
+    nodes = MaterialStore.from_records(rows)
+    return expand_bom(nodes, {row[0] for row in rows}, edges, material_nos)
+
+
+def tokens(store, field):
+    return store.token_lists(field, np.arange(len(store))).to_pylist()
+
+
+def nutrient(store, name):
+    return store.nutrients[:, store.nutrient_names.index(name)]
+
+
+def test_tokens_and_nutrients_roll_up():
+    rows = [
+        ("cake", "", "", "", ""),
+        ("dough", "wheat flour, butter", "gluten, milk", "", "Energy: 400 kcal, Fat: 20 g"),
+        ("filling", "hazelnuts, sugar", "hazelnut", "peanut", "Energy: 500 kcal"),
+    ]
+    edges = {"cake": (["dough", "filling"], [70, 30])}
+    store, cycles, unquantified = expand(rows, edges, ["cake", "filling"])
+    assert cycles == [] and unquantified == []
+    assert store.material_no.tolist() == ["cake", "filling"]
+    assert [sorted(t) for t in tokens(store, "allergen")] == [["gluten", "hazelnut", "milk"], ["hazelnut"]]
+    assert tokens(store, "allergen_may_contain") == [["peanut"], ["peanut"]]
+    np.testing.assert_allclose(nutrient(store, "Energy"), [0.7 * 400 + 0.3 * 500, 500])
+    # Only dough declares fat, so the cake's fat comes from dough alone
+    np.testing.assert_allclose(nutrient(store, "Fat"), [14, np.nan])
+
+
+def test_own_declaration_wins_over_children():
+    rows = [("mix", "", "", "", "Energy: 100 kcal"), ("part", "", "", "", "Energy: 900 kcal")]
+    store, _, _ = expand(rows, {"mix": (["part"], [100])}, ["mix"])
+    np.testing.assert_allclose(nutrient(store, "Energy"), [100])
+
+
+def test_upper_bounds_propagate():
+    rows = [("bar", "", "", "", ""), ("a", "", "", "", "Sugars: <0.5 g"), ("b", "", "", "", "Sugars: 10 g")]
+    store, _, _ = expand(rows, {"bar": (["a", "b"], [50, 50])}, ["bar", "b"])
+    assert store.upper_bounds[:, store.nutrient_names.index("Sugars")].tolist() == [True, False]
+    assert "Sugars: <5.25 g" in store.to_arrow()["nutritional_information"][0].as_py()
+
+
+def test_cycles_are_reported_and_broken():
+    rows = [("a", "sugar", "", "", ""), ("b", "salt", "", "", ""), ("c", "milk", "milk", "", "")]
+    edges = {"a": (["b"], [100]), "b": (["c"], [100]), "c": (["a"], [100])}
+    store, cycles, _ = expand(rows, edges, ["a"])
+    assert cycles == ["a → b → c → a"]
+    assert sorted(tokens(store, "ingredients")[0]) == ["milk", "salt", "sugar"]
+
+
+def test_missing_quantities_are_reported_and_left_out_of_sums():
+    rows = [
+        ("cake", "", "", "", ""),
+        ("dough", "flour", "gluten", "", "Energy: 400 kcal, Fat: 20 g"),
+        ("glaze", "sugar", "", "", "Energy: 300 kcal"),
+    ]
+    store, _, unquantified = expand(rows, {"cake": (["dough", "glaze"], [50, None])}, ["cake"])
+    assert unquantified == ["cake → glaze"]
+    assert sorted(tokens(store, "ingredients")[0]) == ["flour", "sugar"]
+    np.testing.assert_allclose(nutrient(store, "Energy"), [200])
+    # A nutrient only the unquantified child declares stays unknown rather than 0
+    store, _, _ = expand(rows, {"cake": (["glaze"], [None])}, ["cake"])
+    assert np.isnan(nutrient(store, "Energy")).all()
+
+
+def test_unknown_materials_are_skipped():
+    store, _, _ = expand([("a", "sugar", "", "", "")], {}, ["missing", "a", "a"])
+    assert store.material_no.tolist() == ["a"]
+
+
+def reference(rows, edges, node):
+    """Plain recursive roll-up of one node of an acyclic BOM."""
+    own = {row[0]: row for row in rows}[node]
+    found = set(own[1].split(", ")) - {""}
+    energy = float(own[4].split()[1]) if own[4] else None
+    kids, quantities = edges.get(node, ([], []))
+    sums = []
+    for kid, quantity in zip(kids, quantities):
+        kid_tokens, kid_energy = reference(rows, edges, kid)
+        found |= kid_tokens
+        if kid_energy is not None:
+            sums.append(quantity / 100 * kid_energy)
+    if energy is None and sums:
+        energy = sum(sums)
+    return found, energy
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shared_subassemblies_match_a_plain_roll_up(seed):
+    rnd = random.Random(seed)
+    n = 60
+    rows = [(f"m{i}", ", ".join(f"t{rnd.randrange(40)}" for _ in range(rnd.randint(0, 3))), "", "",
+             f"Energy: {rnd.randint(1, 500)} kcal" if rnd.random() < 0.3 else "") for i in range(n)]
+    # Children always have higher numbers, so the BOM is acyclic and many nodes are shared
+    edges = {}
+    for i in range(n - 1):
+        kids = rnd.sample(range(i + 1, n), min(rnd.randint(0, 3), n - i - 1))
+        if kids:
+            edges[f"m{i}"] = ([f"m{k}" for k in kids], [rnd.randint(1, 100) for _ in kids])
+    wanted = [f"m{i}" for i in range(0, n, 7)]
+    store, cycles, _ = expand(rows, edges, wanted)
+    assert cycles == []
+    for row, node in enumerate(wanted):
+        want_tokens, want_energy = reference(rows, edges, node)
+        assert set(tokens(store, "ingredients")[row]) == want_tokens
+        got = nutrient(store, "Energy")[row] if "Energy" in store.nutrient_names else np.nan
+        if want_energy is None:
+            assert np.isnan(got)
+        else:
+            assert got == pytest.approx(want_energy)
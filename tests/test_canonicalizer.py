@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from materials import ALLERGEN_SYNONYMS, Canonicalizer, MaterialStore, field_canonicalizers, records_to_arrow
+
+
+@pytest.fixture(scope="module")
+def canonicalizer():
+    return Canonicalizer()
+
+
+@pytest.fixture(scope="module")
+def canonicalizers():
+    return field_canonicalizers()
+
+
+def ingredients(canonicalizers, *declarations):
+    rows = [(str(i), text, "", "", "") for i, text in enumerate(declarations)]
+    store = MaterialStore.from_arrow(records_to_arrow([rows]), canonicalizers)
+    return store, store.token_lists("ingredients", np.arange(len(rows))).to_pylist()
+
+
+@pytest.mark.parametrize("token, canonical", [
+    ("Sucrose", "sugar"),
+    ("flour wheat", "wheat flour"),
+    ("organic hazelnuts", "hazelnut"),
+    ("soy lecithine", "soya lecithin"),
+    ("hazelnut paste", "hazelnut paste"),
+    ("contains", ""),
+])
+def test_canonical(canonicalizer, token, canonical):
+    assert canonicalizer.canonical(token) == canonical
+
+
+@pytest.mark.parametrize("token, canonical", [
+    ("suger", "sugar"),
+    ("hazlenuts", "hazelnut"),
+    ("rapseed oil", "rapeseed oil"),
+    ("skimmed milk powdr", "skimmed milk powder"),
+])
+def test_misspellings_are_corrected(canonicalizer, token, canonical):
+    assert canonicalizer.canonical(token) == canonical
+
+
+@pytest.mark.parametrize("token", [
+    "wholemeal oat flour",
+    "wholemeal rye flour",
+    "whole goat milk powder",
+    "skimmed goat milk powder",
+    "oat flour",
+    "bread",
+])
+def test_other_ingredients_are_not_merged_into_known_names(canonicalizer, token):
+    assert canonicalizer.canonical(token) == token
+
+
+def test_canonical_pair_takes_single_words(canonicalizer):
+    assert canonicalizer.canonical_pair("flour", "wheat") == "wheat flour"
+    assert canonicalizer.canonical_pair("flour", "whole wheat") is None
+
+
+def test_bracketed_word_merges_into_parent(canonicalizers):
+    _, lists = ingredients(canonicalizers, "flour (wheat), lecithin (soya)")
+    assert lists == [["wheat flour", "soya lecithin"]]
+
+
+def test_neighbouring_tokens_stay_apart(canonicalizers):
+    _, lists = ingredients(canonicalizers, "sugar, wheat, flour, salt", "sea, salt, soya, lecithin")
+    assert lists == [["sugar", "wheat", "flour", "salt"], ["sea", "salt", "soya", "lecithin"]]
+
+
+def test_bracket_with_several_words_is_kept(canonicalizers):
+    _, lists = ingredients(canonicalizers, "flour (wheat, barley)")
+    assert lists == [["flour", "wheat", "barley"]]
+
+
+def test_parents_follow_merges_and_dropped_tokens(canonicalizers):
+    store, lists = ingredients(canonicalizers, "salt, flour (wheat (gluten)), contains (milk)")
+    assert lists == [["salt", "wheat flour", "gluten", "milk"]]
+    assert store.parents.tolist() == [-1, -1, 1, -1]
+
+
+@pytest.mark.parametrize("token", ["flavouring", "corn flour", "milk fat", "butterfat", "anhydrous milk fat", "whey",
+                                   "lactose", "milk protein"])
+def test_distinct_ingredients_keep_their_names(canonicalizer, token):
+    assert canonicalizer.canonical(token) == token
+
+
+def test_allergen_synonyms_only_apply_to_allergen_fields(canonicalizers):
+    rows = [("1", "sugar, lactose, milk protein", "lactose, Soybeans", "cereals containing gluten", "")]
+    store = MaterialStore.from_arrow(records_to_arrow([rows]), canonicalizers)
+    lists = {field: store.token_lists(field, np.arange(1)).to_pylist()[0]
+             for field in ("ingredients", "allergen", "allergen_may_contain")}
+    assert lists == {"ingredients": ["sugar", "lactose", "milk protein"], "allergen": ["milk", "soya"],
+                     "allergen_may_contain": ["gluten"]}
+    assert Canonicalizer(ALLERGEN_SYNONYMS).canonical("milk protein") == "milk"
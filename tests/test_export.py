@@ -0,0 +1,102 @@
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import materials
+from benchmarks import make_rows
+from materials import EXPORT_DATASETS, EXPORT_FORMATS, MaterialStore, export_batches, flatten_lists, write_export
+
+
+@pytest.fixture(scope="module")
+def store():
+    rows = list(make_rows(30))
+    # A material without any allergen claims and one without nutrition
+    rows[3] = rows[3][:2] + ("", "", rows[3][4])
+    rows[11] = rows[11][:4] + ("",)
+    return MaterialStore.from_records(rows)
+
+
+def read_back(path, fmt):
+    if fmt == "Parquet":
+        return pq.read_table(path).to_pandas()
+    if fmt == "CSV":
+        return pd.read_csv(path, dtype=str, keep_default_na=False)
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    frames = []
+    for sheet in workbook.worksheets:
+        header, *values = sheet.iter_rows(values_only=True)
+        frames.append(pd.DataFrame(values, columns=header))
+    return pd.concat(frames, ignore_index=True)
+
+
+def whole(store, dataset):
+    """The dataset as one frame, built in a single chunk."""
+    (batch,) = export_batches(store, dataset, chunk_rows=len(store))
+    return flatten_lists(batch).to_pandas()
+
+
+@pytest.mark.parametrize("dataset", EXPORT_DATASETS)
+def test_chunks_share_one_schema(store, dataset):
+    batches = list(export_batches(store, dataset, chunk_rows=7))
+    expected = 1 if dataset == "Nutrition totals" else 5
+    assert len(batches) == expected
+    assert all(batch.schema == batches[0].schema for batch in batches)
+    assert pa.Table.from_batches(batches).to_pandas().equals(
+        pa.Table.from_batches(list(export_batches(store, dataset, chunk_rows=1000))).to_pandas())
+
+
+def test_allergen_matrix_marks_each_claim(store):
+    matrix = whole(store, "Allergen matrix")
+    rows = np.arange(len(store))
+    contains = store.token_lists("allergen", rows).to_pylist()
+    may_contain = store.token_lists("allergen_may_contain", rows).to_pylist()
+    allergens = sorted(set(sum(contains, [])) | set(sum(may_contain, [])))
+    assert list(matrix.columns) == ["material_no"] + allergens
+    for row in rows:
+        for allergen in allergens:
+            want = "contains" if allergen in contains[row] else "may contain" if allergen in may_contain[row] else None
+            got = matrix.at[row, allergen]
+            assert (pd.isna(got) and want is None) or got == want
+    assert matrix.iloc[3, 1:].isna().all()
+
+
+@pytest.mark.parametrize("fmt", list(EXPORT_FORMATS))
+@pytest.mark.parametrize("dataset", ["Parsed lookup", "Parsed fields", "Allergen matrix"])
+def test_written_files_read_back(store, tmp_path, fmt, dataset):
+    path = tmp_path / f"export{EXPORT_FORMATS[fmt][0]}"
+    assert write_export(export_batches(store, dataset, chunk_rows=7), fmt, str(path)) == len(store)
+    got, want = read_back(path, fmt), whole(store, dataset)
+    assert list(got.columns) == list(want.columns)
+    assert got["material_no"].astype(str).tolist() == want["material_no"].tolist()
+    assert got["material_no"].count() == len(store)
+    if dataset == "Parsed lookup":
+        assert got.fillna("").astype(str).equals(want.fillna("").astype(str))
+
+
+def test_excel_rolls_over_to_new_sheets(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(materials, "EXCEL_SHEET_ROWS", 12)
+    path = tmp_path / "export.xlsx"
+    write_export(export_batches(store, "Parsed lookup", chunk_rows=7), "Excel", str(path))
+    sheets = openpyxl.load_workbook(path, read_only=True).worksheets
+    assert [len(list(sheet.iter_rows())) for sheet in sheets] == [13, 13, 7]
+    assert read_back(path, "Excel")["material_no"].tolist() == store.material_no.tolist()
+
+
+@pytest.mark.parametrize("fmt", list(EXPORT_FORMATS))
+@pytest.mark.parametrize("dataset", EXPORT_DATASETS)
+def test_empty_store_writes_header_only(tmp_path, fmt, dataset):
+    store = MaterialStore.from_records([])
+    path = tmp_path / f"export{EXPORT_FORMATS[fmt][0]}"
+    assert write_export(export_batches(store, dataset, chunk_rows=7), fmt, str(path)) == 0
+    assert len(read_back(path, fmt)) == 0
+
+
+def test_nutrition_totals_use_weights(store):
+    weights = {m: 50 for m in store.material_no.categories}
+    totals = whole(store, "Nutrition totals")
+    halved = flatten_lists(next(export_batches(store, "Nutrition totals", weights))).to_pandas()
+    assert totals["nutrient"].tolist() == store.nutrient_names
+    np.testing.assert_allclose(halved["value"], totals["value"] / 2, atol=0.01)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from benchmarks import make_rows
+
+from materials import DEFAULT_WEIGHT, MaterialStore, NutritionTotals, materials_with_allergens, optimize_weights
+
+ROWS = [
+    ("1", "sugar", "", "", "Energy: 400 kcal, Sugars: 100 g"),
+    ("2", "wheat flour", "gluten", "", "Energy: 350 kcal, Sugars: 1 g"),
+    ("3", "cocoa butter", "", "milk", "Energy: 900 kcal, Sugars: 0 g"),
+]
+
+
+@pytest.fixture
+def totals():
+    return NutritionTotals(MaterialStore.from_records(ROWS), {"1": 50, "2": 30, "3": 20})
+
+
+def nutrient(totals, weights, name):
+    return weights @ totals.per_gram[:, totals.store.nutrient_names.index(name)]
+
+
+def test_totals_follow_weight_edits(totals):
+    totals.update(["1", "unknown"], [100, 5])
+    assert totals.weight_map() == {"1": 100.0, "2": 30.0, "3": 20.0}
+    np.testing.assert_allclose(totals.totals, np.array([100, 30, 20]) @ totals.per_gram)
+
+
+def test_missing_weights_are_not_zero(totals):
+    totals.update(["1", "2"], [None, float("nan")])
+    assert totals.weight_map() == {"1": 50.0, "2": 30.0, "3": 20.0}
+    assert NutritionTotals(totals.store, {}).weights.tolist() == [DEFAULT_WEIGHT] * 3
+
+
+def test_current_weights_kept_when_targets_hold(totals):
+    weights, message = optimize_weights(totals, 100, {"Sugars": (None, 60)})
+    np.testing.assert_allclose(weights, [50, 30, 20], atol=1e-6)
+    assert message == "Changed 0 of 3 weights"
+
+
+def test_targets_and_mass_are_met(totals):
+    weights, _ = optimize_weights(totals, 200, {"Sugars": (None, 40), "Energy": (500, None)})
+    assert weights.sum() == pytest.approx(200)
+    assert nutrient(totals, weights, "Sugars") <= 40 + 1e-6
+    assert nutrient(totals, weights, "Energy") >= 500 - 1e-6
+    assert (weights >= -1e-9).all()
+
+
+def test_excluded_materials_get_zero(totals):
+    excluded = materials_with_allergens(totals.store, {"gluten", "milk"})
+    assert excluded.tolist() == [False, True, True]
+    weights, _ = optimize_weights(totals, 100, {}, excluded)
+    np.testing.assert_allclose(weights, [100, 0, 0], atol=1e-6)
+
+
+def test_infeasible_targets(totals):
+    weights, message = optimize_weights(totals, 100, {"Energy": (None, 100)})
+    assert weights is None
+    assert message
+
+
+def test_large_formulation():
+    store = MaterialStore.from_records(make_rows(20_000))
+    totals = NutritionTotals(store, {m: 10 for m in store.material_no.categories})
+    sugars = totals.totals[store.nutrient_names.index("Sugars")]
+    weights, _ = optimize_weights(totals, 200_000, {"Sugars": (None, 0.8 * sugars)})
+    assert weights.sum() == pytest.approx(200_000)
+    assert nutrient(totals, weights, "Sugars") <= 0.8 * sugars * (1 + 1e-9)
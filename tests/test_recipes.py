@@ -0,0 +1,76 @@
+import io
+import zipfile
+
+import pandas as pd
+import pytest
+
+from materials import expand_uploads, merge_weights, read_recipe_file, validate_recipe
+
+
+def validate(material_nos, weights):
+    return validate_recipe(pd.DataFrame({"material_no": material_nos, "weight": weights}, dtype=str))
+
+
+def issues_by_row(issues):
+    return {row: list(group["issue"]) for row, group in issues.groupby("row")}
+
+
+def test_ids_are_normalized_with_a_warning():
+    recipe, issues = validate([" 1234.0", "1234", "9 "], ["1", "2", "3"])
+    assert recipe.to_dict("list") == {"material_no": ["1234", "9"], "weight": [3.0, 3.0]}
+    normalized = "material_no normalized (spaces or trailing '.0' removed)"
+    assert issues_by_row(issues) == {
+        2: [normalized, "duplicate material, weights summed"],
+        3: ["duplicate material, weights summed"],
+        4: [normalized],
+    }
+    assert set(issues["severity"]) == {"warning"}
+
+
+@pytest.mark.parametrize("weight, issue", [
+    ("x", "weight is not a number"),
+    ("inf", "weight is not a finite number"),
+    ("1e400", "weight is not a finite number"),
+    ("-inf", "weight is not a finite number"),
+    ("-3", "negative weight"),
+])
+def test_bad_weights_are_rejected(weight, issue):
+    recipe, issues = validate(["1", "2"], [weight, "10"])
+    assert recipe["material_no"].tolist() == ["2"]
+    assert issues[["row", "severity", "issue"]].values.tolist() == [[2, "error", issue]]
+
+
+def test_blank_rows_are_skipped_and_missing_weights_defaulted():
+    recipe, issues = validate(["1", None, None], [None, None, "5"])
+    assert recipe.to_dict("list") == {"material_no": ["1"], "weight": [100.0]}
+    assert issues_by_row(issues) == {2: ["no weight, 100 g assumed"], 4: ["missing material_no"]}
+
+
+def test_read_recipe_file_keeps_row_numbers():
+    recipe = read_recipe_file("r.csv", b"material_no,weight\n1,10\n\n2,abc\n3,5\n")
+    assert recipe["weights"] == {"1": 10.0, "3": 5.0}
+    assert recipe["issues"]["row"].tolist() == [4]
+
+
+def test_read_recipe_file_without_material_column():
+    assert "error" in read_recipe_file("r.csv", b"id,weight\n1,10\n")
+
+
+class Upload:
+    def __init__(self, name, data):
+        self.name, self.data = name, data
+
+    def getvalue(self):
+        return self.data
+
+
+def test_repeated_upload_names_are_numbered():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("recipe.csv", "material_no,weight\n3,30\n")
+        zf.writestr("__MACOSX/._recipe.csv", "")
+    uploads = [Upload("recipe.csv", b"material_no,weight\n1,10\n"), Upload("recipe.csv", b"material_no,weight\n2,20\n"),
+               Upload("batch.zip", archive.getvalue())]
+    files = expand_uploads(uploads)
+    assert [name for name, _ in files] == ["recipe.csv", "recipe (2).csv", "batch.zip/recipe.csv"]
+    assert merge_weights({name: read_recipe_file(name, data) for name, data in files}) == {"1": 10.0, "2": 20.0, "3": 30.0}
@@ -0,0 +1,90 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks import calculate_nutrition, make_rows, parse_fields
+from materials import RAW_COLUMNS, MaterialStore, records_to_arrow
+
+ROWS = [
+    ("1", "Sugar, wheat flour and salt", "gluten", "milk", "Energy: 400 kcal, Fat: 2 g"),
+    ("2", "milk chocolate (sugar, cocoa butter)", "milk", "", "Energy: 500 kcal, Sodium: <5 mg"),
+    ("1", "salt", "", "soya", "Fat: 1 g"),
+]
+
+
+@pytest.fixture
+def store():
+    return MaterialStore.from_arrow(records_to_arrow([ROWS]))
+
+
+def test_from_arrow_interns_tokens(store):
+    assert len(store) == 3
+    assert store.material_no.tolist() == ["1", "2", "1"]
+    assert store.token_lists("ingredients", np.arange(3)).to_pylist() == [
+        ["sugar", "wheat flour", "salt"], ["milk chocolate", "sugar", "cocoa butter"], ["salt"]]
+    # One shared vocabulary: 'milk' is interned once for both allergen fields
+    assert sorted(store.vocab).count("milk") == 1
+    assert store.parents.tolist() == [-1, -1, -1, -1, 3, 3, -1]
+    assert store.nutrient_names == ["Energy", "Fat", "Sodium"]
+    assert store.nutrient_units == ["kcal", "g", "mg"]
+    np.testing.assert_array_equal(store.nutrients, [[400, 2, np.nan], [500, np.nan, 5], [np.nan, 1, np.nan]])
+    assert store.upper_bounds.tolist() == [[False, False, False], [False, False, True], [False, False, False]]
+
+
+def test_unique_tokens(store):
+    assert store.unique_tokens("allergen_may_contain") == ["milk", "soya"]
+    assert store.unique_tokens("ingredients", np.array([False, False, True])) == ["salt"]
+    assert store.unique_tokens("allergen", np.zeros(3, dtype=bool)) == []
+
+
+def test_nbytes_counts_every_array(store):
+    arrays = sum(offsets.nbytes + codes.nbytes for offsets, codes in store.lists.values())
+    arrays += store.parents.nbytes + store.nutrients.nbytes + store.upper_bounds.nbytes
+    strings = sum(sys.getsizeof(token) for token in store.vocab)
+    assert store.nbytes >= arrays + strings
+
+
+def test_nutrition_totals_match_legacy():
+    rows = list(make_rows(500))
+    weights = {row[0]: (i % 50) + 1 for i, row in enumerate(rows)}
+    store = MaterialStore.from_records(rows)
+    legacy = calculate_nutrition(parse_fields(pd.DataFrame(rows, columns=RAW_COLUMNS)), weights)
+    assert store.nutrition_totals(weights) == legacy
+    assert store.nutrition_totals() == calculate_nutrition(parse_fields(pd.DataFrame(rows, columns=RAW_COLUMNS)))
+
+
+def test_records_to_arrow_keeps_null_columns_and_batches():
+    table = records_to_arrow([[("1", None, None, None, None), ("2", "salt", None, None, None)], [],
+                              [(3, None, "milk", None, None)]])
+    assert table.schema.names == RAW_COLUMNS
+    assert all(str(field.type) == "string" for field in table.schema)
+    assert len(table.to_batches()) == 2
+    assert table.column("material_no").to_pylist() == ["1", "2", "3"]
+    assert table.column("allergen_may_contain").null_count == 3
+
+
+def test_empty_lookup():
+    store = MaterialStore.from_arrow(records_to_arrow([]))
+    assert len(store) == 0 and store.nutrient_names == []
+    table = store.to_arrow()
+    assert table.schema.names == RAW_COLUMNS and table.num_rows == 0
+    assert store.nutrition_totals() == {}
+
+
+def test_to_arrow_renders_parsed_values(store):
+    assert store.to_arrow([1, 2]).to_pylist() == [
+        {"material_no": "2", "ingredients": "milk chocolate, sugar, cocoa butter", "allergen": "milk",
+         "allergen_may_contain": "", "nutritional_information": "Energy: 500 kcal, Sodium: <5 mg"},
+        {"material_no": "1", "ingredients": "salt", "allergen": "", "allergen_may_contain": "soya",
+         "nutritional_information": "Fat: 1 g"},
+    ]
+
+
+def test_to_arrow_round_trips(store):
+    rebuilt = MaterialStore.from_arrow(store.to_arrow())
+    assert rebuilt.to_arrow().equals(store.to_arrow())
+    np.testing.assert_array_equal(rebuilt.nutrients, store.nutrients)
+    assert rebuilt.upper_bounds.tolist() == store.upper_bounds.tolist()
+    assert rebuilt.nutrient_units == store.nutrient_units
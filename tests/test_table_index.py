@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from materials import SEARCH_SCOPES, MaterialStore, TableIndex
+
+ROWS = [
+    ("10", "sugar, salt", "", "", ""),
+    ("9", "", "", "", ""),
+    ("A7", "cocoa butter", "milk", "", ""),
+    ("100", "", "", "", ""),
+    ("2", "wheat flour, sugar", "gluten", "", ""),
+]
+
+
+@pytest.fixture
+def index():
+    return TableIndex(MaterialStore.from_records(ROWS))
+
+
+def materials(table):
+    return table.column("material_no").to_pylist()
+
+
+def test_material_numbers_sort_numerically_then_as_text(index):
+    assert index.order("material_no").tolist() == [4, 1, 0, 3, 2]
+
+
+def test_list_columns_sort_by_their_joined_text(index):
+    # Rows without ingredients sort first as ''
+    assert index.order("ingredients").tolist() == [1, 3, 2, 0, 4]
+    assert index.order("allergen")[-2:].tolist() == [4, 2]
+
+
+def test_token_hits_map_back_to_their_rows(index):
+    # Rows 1 and 3 have no tokens, so positions and rows differ
+    assert np.flatnonzero(index.matching_rows("SUGAR", ["ingredients"])).tolist() == [0, 4]
+    assert np.flatnonzero(index.matching_rows("flour", ["ingredients"])).tolist() == [4]
+    assert np.flatnonzero(index.matching_rows("milk", ["allergen"])).tolist() == [2]
+    assert np.flatnonzero(index.matching_rows("a7", ["material_no"])).tolist() == [2]
+    assert np.flatnonzero(index.matching_rows("10", SEARCH_SCOPES["All"])).tolist() == [0, 3]
+    assert index.matching_rows("  ", ["ingredients"]).all()
+    assert not index.matching_rows("pepper", SEARCH_SCOPES["All"]).any()
+
+
+def test_pages_follow_sort_direction_and_mask(index):
+    everything = index.matching_rows("", ["material_no"])
+    assert materials(index.page(everything, "material_no", False, 1, 2)) == ["2", "9"]
+    assert materials(index.page(everything, "material_no", False, 3, 2)) == ["A7"]
+    assert materials(index.page(everything, "material_no", True, 1, 2)) == ["A7", "100"]
+    assert materials(index.page(everything, "material_no", True, 2, 2)) == ["10", "9"]
+    sugar = index.matching_rows("sugar", ["ingredients"])
+    assert materials(index.page(sugar, "material_no", True, 1, 25)) == ["10", "2"]
+    assert index.page(sugar, "material_no", False, 2, 25).num_rows == 0
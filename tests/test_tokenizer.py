@@ -0,0 +1,52 @@
+import random
+
+import pyarrow as pa
+import pytest
+
+from materials import tokenize_column, tokenize_ingredients
+
+
+def column_tokens(texts):
+    """tokenize_column() output regrouped into one token list per input row."""
+    tokens, rows = tokenize_column(pa.array(texts, pa.string()))
+    grouped = [[] for _ in texts]
+    for token, row in zip(tokens.to_pylist(), rows):
+        grouped[row].append(token)
+    return grouped
+
+
+def test_nested_declaration():
+    text = "Chocolate 20% (sugar, cocoa butter, milk powder 3,5%), salt"
+    assert tokenize_ingredients(text) == (
+        ["chocolate", "sugar", "cocoa butter", "milk powder", "salt"], [-1, 0, 0, 0, -1])
+
+
+def test_text_after_bracket_extends_owner():
+    assert tokenize_ingredients("milk (skimmed) powder, salt") == (["milk powder", "skimmed", "salt"], [-1, 0, -1])
+
+
+def test_missing_values():
+    assert tokenize_ingredients(None) == ([], [])
+    assert tokenize_ingredients(float("nan")) == ([], [])
+
+
+@pytest.mark.parametrize("text, tokens", [
+    ("sugar) milk", ["sugar", "milk"]),
+    ("]", []),
+    ("salt, sugar}", ["salt", "sugar"]),
+    ("wheat (gluten)) , salt", ["wheat", "gluten", "salt"]),
+])
+def test_unmatched_closing_brackets_separate(text, tokens):
+    assert tokenize_ingredients(text)[0] == tokens
+    assert column_tokens([text]) == [tokens]
+
+
+def test_column_matches_declarations():
+    pieces = ["a", "b", "milk", "Soya", " ", " ", ",", ";", " and ", "(", ")", "[", "]", "{", "}",
+              "%", "3", ".", "5", "\t"]
+    rnd = random.Random(0)
+    texts = ["".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 12))) for _ in range(20_000)]
+    texts += [None, ""]
+    expected = [tokenize_ingredients(text)[0] for text in texts]
+    mismatches = [(text, got, want) for text, got, want in zip(texts, column_tokens(texts), expected) if got != want]
+    assert mismatches == []